@@ -1,12 +1,12 @@
-from tkinter import Tk, Frame, Listbox, Scrollbar, VERTICAL, RIGHT, Y, BOTH
-from gui import PanZoomCanvas, browse_images, display_image
+from tkinter import Tk, Frame, BOTH
+from gui import PanZoomCanvas, HistogramPanel, VirtualImageList, browse_images, display_image
 from process import get_elipses
 
 def setup_ui():
     """Set up the main application window and widgets."""
     app = Tk()
     app.title("Image Browser with Pan and Zoom")
-    app.geometry("1300x540")
+    app.geometry("1300x700")
 
     list_frame = Frame(app)
     list_frame.pack(side="left", fill="y")
@@ -14,21 +14,17 @@ def setup_ui():
     canvas_frame = Frame(app)
     canvas_frame.pack(side="right", expand=True, fill="both")
 
-    listbox = Listbox(list_frame, width=50, height=30)
-    listbox.pack(side="left", fill="y", padx=10, pady=10)
-
-    scrollbar = Scrollbar(list_frame, orient=VERTICAL)
-    scrollbar.pack(side=RIGHT, fill=Y)
-
-    listbox.config(yscrollcommand=scrollbar.set)
-    scrollbar.config(command=listbox.yview)
+    histogram = HistogramPanel(canvas_frame, height=160, bg="white")
+    histogram.pack(side="bottom", fill="x")
 
     canvas = PanZoomCanvas(canvas_frame, bg="white")
     canvas.pack(expand=True, fill=BOTH)
+    canvas.add_listener(histogram.show_stats)
 
-    listbox.bind("<<ListboxSelect>>", lambda event: display_image(event, listbox, canvas, get_elipses))
+    browser = VirtualImageList(list_frame, lambda file_name: display_image(file_name, canvas, get_elipses))
+    browser.pack(side="left", fill="y", padx=10, pady=10)
 
-    browse_images(listbox)
+    browse_images(browser)
 
     return app
 
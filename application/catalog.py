@@ -0,0 +1,195 @@
+"""Index of input images by core ID and capture time, kept in step with the file system.
+
+The directory is only listed again when its own mtime changes (files added, removed
+or renamed). Otherwise the catalogued files are stat'ed one by one, so a file
+rewritten in place under the same name is still picked up through its size and
+mtime, and its measurement status is reset.
+"""
+import os
+import re
+import time
+import sqlite3
+import argparse
+from datetime import datetime
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tiff", ".gif")
+
+# Names look like <core id>-<yymmddHHMMSS>.jpg, e.g. 233800-240125051452.jpg
+NAME_PATTERN = re.compile(r"^(?P<core>.+)-(?P<timestamp>\d{12})$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    name TEXT NOT NULL,
+    core_id TEXT NOT NULL,
+    captured_at TEXT,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'new'
+);
+CREATE INDEX IF NOT EXISTS images_directory ON images (directory, name);
+CREATE INDEX IF NOT EXISTS images_core ON images (core_id, captured_at);
+CREATE INDEX IF NOT EXISTS images_captured ON images (captured_at);
+CREATE INDEX IF NOT EXISTS images_status ON images (status);
+CREATE TABLE IF NOT EXISTS directories (
+    directory TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    scanned REAL NOT NULL
+);
+"""
+
+def parse_name(name):
+    """Return (core_id, captured_at) parsed from an image name; captured_at is None if absent."""
+    base = os.path.splitext(os.path.basename(name))[0]
+    match = NAME_PATTERN.match(base)
+    if not match:
+        return base, None
+    try:
+        captured_at = datetime.strptime(match["timestamp"], "%y%m%d%H%M%S").isoformat(sep=" ")
+    except ValueError:
+        captured_at = None
+    return match["core"], captured_at
+
+def open_catalog(db_path="./data/catalog.sqlite"):
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=60)
+    conn.executescript(SCHEMA)
+    return conn
+
+def image_row(path, directory, name, stat):
+    core_id, captured_at = parse_name(name)
+    return path, directory, name, core_id, captured_at, stat.st_size, stat.st_mtime_ns
+
+def update(conn, directory, force=False):
+    """Bring the catalog of a directory up to date; returns the number of added, changed or removed files.
+
+    While the directory's own mtime is unchanged only the catalogued files are
+    stat'ed, without listing the directory; ``force`` lists it regardless.
+    """
+    directory = os.path.abspath(directory)
+    directory_mtime = os.stat(directory).st_mtime_ns
+    row = conn.execute("SELECT mtime_ns FROM directories WHERE directory = ?", (directory,)).fetchone()
+    known = {
+        path: (name, size, mtime_ns)
+        for path, name, size, mtime_ns in conn.execute(
+            "SELECT path, name, size, mtime_ns FROM images WHERE directory = ?", (directory,)
+        )
+    }
+
+    changed = []
+    removed = []
+    if row and row[0] == directory_mtime and not force:
+        for path, (name, size, mtime_ns) in known.items():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                removed.append((path,))
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                changed.append(image_row(path, directory, name, stat))
+        if not changed and not removed:
+            return 0
+    else:
+        seen = set()
+        for entry in os.scandir(directory):
+            if not entry.is_file() or not entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            path = os.path.join(directory, entry.name)
+            seen.add(path)
+            stat = entry.stat()
+            if known.get(path, (None,))[1:] == (stat.st_size, stat.st_mtime_ns):
+                continue
+            changed.append(image_row(path, directory, entry.name, stat))
+        removed = [(path,) for path in known if path not in seen]
+
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO images (path, directory, name, core_id, captured_at, size, mtime_ns) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            changed,
+        )
+        conn.executemany("DELETE FROM images WHERE path = ?", removed)
+        conn.execute(
+            "INSERT OR REPLACE INTO directories (directory, mtime_ns, scanned) VALUES (?, ?, ?)",
+            (directory, directory_mtime, time.time()),
+        )
+
+    return len(changed) + len(removed)
+
+def select(conn, directory=None, core_prefix=None, core_ids=None, since=None, until=None, status=None,
+           order="core_id, captured_at, name"):
+    """Return catalogued image paths matching every given filter.
+
+    ``since``/``until`` are ISO timestamps (``"2024-01-25 05:00:00"``), ``status`` a
+    measurement status or list of them.
+    """
+    clauses, values = [], []
+    if directory is not None:
+        clauses.append("directory = ?")
+        values.append(os.path.abspath(directory))
+    if core_prefix:
+        # A range instead of LIKE so the core index is used
+        clauses.append("core_id >= ? AND core_id < ?")
+        values += [core_prefix, core_prefix + "\uffff"]
+    if core_ids is not None:
+        core_ids = list(core_ids)
+        clauses.append(f"core_id IN ({', '.join('?' * len(core_ids))})")
+        values += core_ids
+    if since is not None:
+        clauses.append("captured_at >= ?")
+        values.append(since)
+    if until is not None:
+        clauses.append("captured_at <= ?")
+        values.append(until)
+    if status is not None:
+        status = [status] if isinstance(status, str) else list(status)
+        clauses.append(f"status IN ({', '.join('?' * len(status))})")
+        values += status
+
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    return [path for (path,) in conn.execute(f"SELECT path FROM images {where} ORDER BY {order}", values)]
+
+def select_images(directory, db_path="./data/catalog.sqlite", **filters):
+    """Update the catalog of a directory and return its images matching the filters."""
+    conn = open_catalog(db_path)
+    try:
+        update(conn, directory)
+        return select(conn, directory=directory, **filters)
+    finally:
+        conn.close()
+
+def set_status(conn, paths, status):
+    """Record the measurement status of images."""
+    with conn:
+        conn.executemany("UPDATE images SET status = ? WHERE path = ?", [(status, path) for path in paths])
+
+def sync_status(conn, jobs_db_path):
+    """Copy the measurement status of every queued image from a job queue database."""
+    conn.execute("ATTACH DATABASE ? AS queue", (jobs_db_path,))
+    try:
+        with conn:
+            conn.execute(
+                "UPDATE images SET status = (SELECT status FROM queue.jobs WHERE queue.jobs.path = images.path) "
+                "WHERE path IN (SELECT path FROM queue.jobs)"
+            )
+    finally:
+        conn.execute("DETACH DATABASE queue")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index images by core ID and capture time.")
+    parser.add_argument("directory", nargs="?", default="./data/input/")
+    parser.add_argument("--db", default="./data/catalog.sqlite")
+    parser.add_argument("--force", action="store_true", help="Re-list the directory even if it looks unchanged")
+    parser.add_argument("--jobs", help="Job queue database to copy measurement status from")
+    args = parser.parse_args()
+
+    conn = open_catalog(args.db)
+    print(f"{update(conn, args.directory, args.force)} files added, changed or removed")
+    if args.jobs:
+        sync_status(conn, args.jobs)
+    for core_id, count, first, last in conn.execute(
+        "SELECT core_id, COUNT(*), MIN(captured_at), MAX(captured_at) FROM images GROUP BY core_id ORDER BY core_id"
+    ):
+        print(f"{core_id}: {count} images, {first} to {last}")
+    conn.close()
@@ -0,0 +1,232 @@
+import os
+import re
+import csv
+import json
+import sqlite3
+import argparse
+from functools import lru_cache
+import numpy as np
+from scipy.special import kolmogorov
+try:
+    from catalog import parse_name
+except ImportError:  # imported as application.grainstats, e.g. by final.py
+    from application.catalog import parse_name
+
+# Percentiles (of grain size, finest first) needed for D50 and the sorting coefficients
+PERCENTILES = np.array([5, 16, 25, 50, 75, 84, 95])
+
+# Scholz & Stephens (1987) table 2, critical values of the standardised two-sample statistic (m = 1)
+AD_SIGNIFICANCE = np.array([0.25, 0.1, 0.05, 0.025, 0.01, 0.005, 0.001])
+AD_CRITICAL = (
+    np.array([0.675, 1.281, 1.645, 1.96, 2.326, 2.573, 3.085])
+    + np.array([-0.245, 0.25, 0.678, 1.149, 1.822, 2.364, 3.615])
+    + np.array([-0.105, -0.305, -0.362, -0.391, -0.396, -0.345, -0.154])
+)
+
+def assign_groups(names, rules=None):
+    """Map each image name to a group.
+
+    ``rules`` is a list of (regex, group) pairs tried in order against the file name,
+    e.g. [("^23380[01]", "Muddy Core"), (".*", "Sandy Core")]; names matching no rule
+    (or every name, when no rules are given) are grouped by core ID.
+    """
+    compiled = [(re.compile(pattern), group) for pattern, group in (rules or [])]
+    groups = {}
+    for name in names:
+        base = os.path.basename(name)
+        groups[name] = next((group for pattern, group in compiled if pattern.search(base)), parse_name(base)[0])
+    return groups
+
+def pool_groups(samples, groups):
+    """Concatenate the grain arrays of the images in each group."""
+    pooled = {}
+    for name, sample in samples.items():
+        pooled.setdefault(groups[name], []).append(np.asarray(sample, dtype=float))
+    return {group: np.concatenate(parts) for group, parts in pooled.items()}
+
+def cumulative_counts(samples, max_grid=4096):
+    """Count, for every sample, the grains at or below each point of a shared grid.
+
+    The grid is the pooled set of grain sizes, thinned to ``max_grid`` quantiles of
+    it when larger; with ``max_grid=None`` the statistics below are exact.
+    """
+    sorted_samples = [np.sort(np.asarray(sample, dtype=float)) for sample in samples]
+    grid = np.unique(np.concatenate(sorted_samples))
+    if max_grid and len(grid) > max_grid:
+        grid = np.unique(np.quantile(grid, np.linspace(0, 1, max_grid)))
+    counts = np.stack([np.searchsorted(sample, grid, side="right") for sample in sorted_samples])
+    return grid, counts, np.array([len(sample) for sample in sorted_samples])
+
+@lru_cache(maxsize=None)
+def harmonic_terms(total):
+    """The h and g sums of Scholz & Stephens (1987) for a pooled sample of ``total`` values."""
+    partial_sums = (1 / np.arange(total - 1, 1, -1)).cumsum()
+    return partial_sums[-1] + 1, (partial_sums / np.arange(2, total)).sum()
+
+def standardize_anderson_darling(statistic, n_a, n_b):
+    """Standardise a two-sample A2 by its exact mean and variance under the null (Scholz & Stephens 1987)."""
+    total = n_a + n_b
+    if total < 4:
+        return np.nan
+    h, g = harmonic_terms(total)
+    k = 2
+    harmonic = 1 / n_a + 1 / n_b
+    a = (4 * g - 6) * (k - 1) + (10 - 6 * g) * harmonic
+    b = (2 * g - 4) * k ** 2 + 8 * h * k + (2 * g - 14 * h - 4) * harmonic - 8 * h + 4 * g - 6
+    c = (6 * h + 2 * g - 2) * k ** 2 + (4 * h - 4 * g + 6) * k + (2 * h - 6) * harmonic + 4 * h
+    d = (2 * h + 6) * k ** 2 - 4 * h * k
+    variance = (a * total ** 3 + b * total ** 2 + c * total + d) / ((total - 1) * (total - 2) * (total - 3))
+    return (statistic - (k - 1)) / np.sqrt(variance)
+
+def anderson_darling_pvalues(standardized):
+    """Approximate p-values of standardised statistics, interpolated in the critical value table.
+
+    As in scipy.stats.anderson_ksamp, values are capped at 0.25 and floored at 0.001.
+    """
+    fit = np.polyfit(AD_CRITICAL, np.log(AD_SIGNIFICANCE), 2)
+    with np.errstate(invalid="ignore"):
+        pvalues = np.exp(np.polyval(fit, standardized))
+        pvalues = np.where(standardized < AD_CRITICAL.min(), AD_SIGNIFICANCE.max(), pvalues)
+        pvalues = np.where(standardized > AD_CRITICAL.max(), AD_SIGNIFICANCE.min(), pvalues)
+    return np.where(np.isnan(standardized), np.nan, pvalues)
+
+def pairwise_tests(samples, max_grid=4096):
+    """Two-sample Kolmogorov-Smirnov and Anderson-Darling tests for every pair of samples.
+
+    Returns (ks_statistic, ks_pvalue, ad_statistic, ad_standardized, ad_pvalue) as
+    symmetric k x k matrices. All pairs involving one sample are evaluated at once on
+    the shared grid. The Anderson-Darling statistic follows Pettitt (1976), with ties
+    counted at the upper end of each grid step (scipy's ``midrank=False``), and is
+    standardised and given a p-value as in ``scipy.stats.anderson_ksamp``.
+    The KS p-values are asymptotic. With ``max_grid`` set and more distinct values
+    than that, both statistics and their p-values are approximations.
+    """
+    _, counts, sizes = cumulative_counts(samples, max_grid)
+    k = len(sizes)
+    ecdf = counts / sizes[:, None]
+
+    ks = np.zeros((k, k))
+    ad = np.zeros((k, k))
+    for i in range(k - 1):
+        others = slice(i + 1, k)
+        ks[i, others] = np.abs(ecdf[others] - ecdf[i]).max(axis=1)
+
+        pooled = counts[others] + counts[i]
+        total = (sizes[others] + sizes[i])[:, None]
+        weights = np.diff(pooled, axis=1, prepend=0)
+        inner = (pooled > 0) & (pooled < total) & (weights > 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            terms = weights * (counts[i] * total - sizes[i] * pooled) ** 2 / (pooled * (total - pooled))
+        ad[i, others] = np.where(inner, terms, 0).sum(axis=1) / (sizes[i] * sizes[others])
+
+    ks += ks.T
+    ad += ad.T
+    effective = sizes[:, None] * sizes[None, :] / (sizes[:, None] + sizes[None, :])
+    pvalues = np.minimum(1, kolmogorov(np.sqrt(effective) * ks))
+
+    ad_standardized = np.zeros((k, k))
+    for i in range(k):
+        for j in range(i + 1, k):
+            ad_standardized[i, j] = ad_standardized[j, i] = standardize_anderson_darling(ad[i, j], sizes[i], sizes[j])
+    return ks, pvalues, ad, ad_standardized, anderson_darling_pvalues(ad_standardized)
+
+def sorting_metrics(percentiles):
+    """D50, Trask sorting coefficient and Folk & Ward graphic standard deviation (phi) from size percentiles.
+
+    ``percentiles`` holds the sizes at PERCENTILES along its last axis.
+    """
+    d5, d16, d25, d50, d75, d84, d95 = np.moveaxis(percentiles, -1, 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        trask = np.sqrt(d75 / d25)
+        folk_ward = np.log2(d84 / d16) / 4 + np.log2(d95 / d5) / 6.6
+    return {"d50": d50, "trask": trask, "folk_ward": folk_ward}
+
+def bootstrap(sample, n_boot=1000, confidence=0.95, rng=None, max_batch_values=20_000_000):
+    """Bootstrap confidence intervals on D50 and the sorting coefficients of one sample.
+
+    Resamples are drawn and summarised in batches of whole (n_boot x n) index arrays,
+    bounded by ``max_batch_values`` to cap memory. Returns {metric: (estimate, low, high)}.
+    """
+    sample = np.asarray(sample, dtype=float)
+    rng = rng or np.random.default_rng()
+    estimate = sorting_metrics(np.percentile(sample, PERCENTILES))
+    if len(sample) < 2:
+        return {name: (float(value), np.nan, np.nan) for name, value in estimate.items()}
+
+    batch = max(1, max_batch_values // len(sample))
+    resampled = []
+    for start in range(0, n_boot, batch):
+        indices = rng.integers(0, len(sample), size=(min(batch, n_boot - start), len(sample)))
+        resampled.append(np.percentile(sample[indices], PERCENTILES, axis=1).T)
+    distribution = sorting_metrics(np.concatenate(resampled))
+
+    tail = (1 - confidence) / 2 * 100
+    return {
+        name: (float(estimate[name]), *(float(v) for v in np.nanpercentile(distribution[name], [tail, 100 - tail])))
+        for name in estimate
+    }
+
+def load_samples(db_path="./data/jobs.sqlite"):
+    """Read the per-image grain arrays (mm) stored by the measurement queue."""
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute("SELECT path, grain_lengths FROM results ORDER BY path").fetchall()
+    conn.close()
+    return {os.path.basename(path): np.array(json.loads(lengths)) for path, lengths in rows}
+
+def write_summary(writer, level, samples, n_boot, rng):
+    for name, sample in samples.items():
+        metrics = bootstrap(sample, n_boot, rng=rng)
+        row = [level, name, len(sample)]
+        for metric in ("d50", "trask", "folk_ward"):
+            row += list(metrics[metric])
+        writer.writerow(row)
+
+def write_pairs(writer, level, samples, max_grid):
+    names = list(samples)
+    if len(names) < 2:
+        return
+    ks, pvalues, ad, ad_standardized, ad_pvalues = pairwise_tests([samples[name] for name in names], max_grid)
+    for i in range(len(names)):
+        for j in range(i + 1, len(names)):
+            writer.writerow([
+                level, names[i], names[j], ks[i, j], pvalues[i, j], ad[i, j], ad_standardized[i, j], ad_pvalues[i, j],
+            ])
+
+def compare(samples, rules, output_dir, n_boot=1000, max_grid=4096, seed=0):
+    """Write bootstrap summaries and pairwise tests for every image and every group."""
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    samples = {name: sample for name, sample in samples.items() if len(sample)}
+    grouped = pool_groups(samples, assign_groups(samples, rules))
+
+    with open(os.path.join(output_dir, "summary.csv"), "w", newline="") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow([
+            "level", "name", "count",
+            "d50", "d50_low", "d50_high",
+            "trask", "trask_low", "trask_high",
+            "folk_ward", "folk_ward_low", "folk_ward_high",
+        ])
+        write_summary(writer, "image", samples, n_boot, rng)
+        write_summary(writer, "group", grouped, n_boot, rng)
+
+    with open(os.path.join(output_dir, "pairs.csv"), "w", newline="") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["level", "a", "b", "ks", "ks_pvalue", "anderson_darling", "ad_standardized", "ad_pvalue"])
+        write_pairs(writer, "image", samples, max_grid)
+        write_pairs(writer, "group", grouped, max_grid)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare grain size distributions between images and cores.")
+    parser.add_argument("--db", default="./data/jobs.sqlite")
+    parser.add_argument("--rules", help='JSON file with [["regex", "group"], ...]; default groups by core ID')
+    parser.add_argument("--bootstrap", type=int, default=1000)
+    parser.add_argument("--max-grid", type=int, default=4096, help="0 for exact statistics on the pooled values")
+    parser.add_argument("--output", default="data/stats-output")
+    args = parser.parse_args()
+
+    rules = None
+    if args.rules:
+        with open(args.rules) as f:
+            rules = json.load(f)
+    compare(load_samples(args.db), rules, args.output, args.bootstrap, args.max_grid or None)
@@ -1,8 +1,17 @@
 import os
+import json
+import queue
+import threading
+from collections import OrderedDict
 from tkinter import Tk, Canvas, Listbox, Scrollbar, Frame, VERTICAL, RIGHT, Y, BOTH
 from tkinter.messagebox import showerror
+from tkinter.simpledialog import askstring
 from PIL import Image, ImageTk
 from math import cos, sin, radians
+from thumbnails import ThumbnailCache, load_measurements
+from catalog import select_images
+from livestats import GrainStats, ellipse_key, apply_delta, load_delta, save_delta
+from process import DEFAULT_SEGMENTATION, load_image, get_elipses_roi, ellipses_in_polygon
 
 class PanZoomCanvas(Canvas):
     def __init__(self, parent, **kwargs):
@@ -17,18 +26,41 @@ class PanZoomCanvas(Canvas):
         self.image_height = 0
         self.selected_ellipse = None
 
+        # Per-image statistics and the manual edits made against the automatic result
+        self.calibration_factor = None
+        self.stats = None
+        self.delta = None
+        self.ellipse_keys = []
+        self.listeners = []
+
+        # Region of interest in image coordinates, re-analysed by on_roi(polygon, params)
+        self.on_roi = None
+        self.roi_params = None
+        self.roi_points = []
+        self.roi_mode = None
+
         # Bind mouse and keyboard events
         self.bind("<ButtonPress-1>", self.start_pan_or_select)
         self.bind("<B1-Motion>", self.pan)
         self.bind("<MouseWheel>", self.zoom)
         self.bind("<Delete>", self.delete_selected_ellipse)
 
+        # Right-drag draws a rectangle ROI, Shift+right-click adds polygon vertices and Return closes it
+        self.bind("<ButtonPress-3>", self.start_roi)
+        self.bind("<B3-Motion>", self.drag_roi)
+        self.bind("<ButtonRelease-3>", self.finish_roi)
+        self.bind("<Shift-ButtonPress-3>", self.add_roi_vertex)
+        self.bind("<Return>", self.close_roi_polygon)
+        self.bind("<Escape>", self.cancel_roi)
+        self.bind("<KeyPress-p>", self.edit_roi_params)
+
         self.start_x = 0
         self.start_y = 0
 
     def start_pan_or_select(self, event):
         self.start_x = event.x
         self.start_y = event.y
+        self.focus_set()
 
         # Check if an ellipse is clicked
         clicked_ellipse = self.find_closest(event.x, event.y)
@@ -77,15 +109,53 @@ class PanZoomCanvas(Canvas):
             self.image_tk = ImageTk.PhotoImage(scaled_image)
             self.create_image(self.offset_x, self.offset_y, image=self.image_tk, anchor="nw")
         self.draw_ellipses(scaled_width, scaled_height)
+        self.draw_roi()
 
-    def set_image(self, img, ellipses, scale_factor):
+    def set_image(self, img, ellipses, scale_factor, calibration_factor=None, max_length_mm=4, delta=None):
         self.original_image = img
-        self.ellipses = ellipses
+        self.calibration_factor = calibration_factor
+        self.delta = delta
+        if delta is not None:
+            removed = apply_delta(ellipses, {**delta, "added": []})
+            self.ellipses = removed + [list(e) for e in delta["added"]]
+            self.ellipse_keys = [ellipse_key(e) for e in removed] + [None] * len(delta["added"])
+        else:
+            self.ellipses = ellipses
+            self.ellipse_keys = [ellipse_key(e) for e in ellipses]
+        if calibration_factor is not None:
+            self.stats = GrainStats(max_length_mm, grain_lengths=[e[4] * calibration_factor for e in self.ellipses])
+        self.selected_ellipse = None
         self.image_width, self.image_height = img.size
         self.offset_x = 0
         self.offset_y = 0
         self.scale_factor = scale_factor * 4
         self.redraw()
+        self.notify()
+
+    def add_listener(self, callback):
+        """Call callback(stats) whenever the set of ellipses changes."""
+        self.listeners.append(callback)
+
+    def notify(self):
+        if self.stats is not None:
+            for callback in self.listeners:
+                callback(self.stats)
+
+    def ellipse_scale(self):
+        """Canvas pixels per image pixel used when drawing ellipses."""
+        compensation_factor = 0.25
+        scaled_width = int(self.image_width * self.scale_factor)
+        scaled_height = int(self.image_height * self.scale_factor)
+        return compensation_factor * scaled_width / self.image_width, compensation_factor * scaled_height / self.image_height
+
+    def canvas_to_image(self, x, y):
+        """Map a canvas position to image pixel coordinates, consistent with the drawn ellipses."""
+        image_scale_x, image_scale_y = self.ellipse_scale()
+        return (x - self.offset_x) / image_scale_x, (y - self.offset_y) / image_scale_y
+
+    def image_to_canvas(self, x, y):
+        image_scale_x, image_scale_y = self.ellipse_scale()
+        return x * image_scale_x + self.offset_x, y * image_scale_y + self.offset_y
 
     def draw_ellipses(self, scaled_width, scaled_height):
         """Draw ellipses with scaling and panning transformations."""
@@ -132,23 +202,296 @@ class PanZoomCanvas(Canvas):
     def delete_selected_ellipse(self, event):
         """Delete the currently selected ellipse."""
         if self.selected_ellipse is not None:
-            del self.ellipses[self.selected_ellipse]
+            ellipse = self.ellipses.pop(self.selected_ellipse)
+            key = self.ellipse_keys.pop(self.selected_ellipse)
             self.selected_ellipse = None
+
+            self.forget_ellipse(ellipse, key)
+            if self.delta is not None:
+                save_delta(self.delta)
+
             self.redraw()
+            self.notify()
+
+    def forget_ellipse(self, ellipse, key):
+        """Record the removal of an ellipse in the edits and statistics."""
+        if self.delta is not None:
+            if key is not None:
+                self.delta["removed"].append(key)
+            else:
+                self.delta["added"].remove(ellipse)
+        if self.stats is not None:
+            self.stats.remove(ellipse[4] * self.calibration_factor)
+
+    def remember_ellipse(self, ellipse):
+        """Record an added ellipse in the edits and statistics."""
+        if self.delta is not None:
+            self.delta["added"].append(list(ellipse))
+        if self.stats is not None:
+            self.stats.add(ellipse[4] * self.calibration_factor)
+
+    def replace_in_roi(self, polygon, new_ellipses):
+        """Swap the ellipses centred inside a polygon for newly measured ones."""
+        kept, kept_keys = [], []
+        for ellipse, key, inside in zip(self.ellipses, self.ellipse_keys, ellipses_in_polygon(self.ellipses, polygon)):
+            if inside:
+                self.forget_ellipse(ellipse, key)
+            else:
+                kept.append(ellipse)
+                kept_keys.append(key)
+
+        for ellipse in new_ellipses:
+            self.remember_ellipse(ellipse)
+        self.ellipses = kept + [list(ellipse) for ellipse in new_ellipses]
+        self.ellipse_keys = kept_keys + [None] * len(new_ellipses)
+        self.selected_ellipse = None
+
+        if self.delta is not None:
+            save_delta(self.delta)
+        self.redraw()
+        self.notify()
+
+    def start_roi(self, event):
+        self.focus_set()
+        self.roi_mode = "rectangle"
+        self.roi_points = [self.canvas_to_image(event.x, event.y)] * 2
+
+    def drag_roi(self, event):
+        if self.roi_mode == "rectangle":
+            self.roi_points[1] = self.canvas_to_image(event.x, event.y)
+            self.draw_roi()
 
-def browse_images(listbox):
-    """Populate the Listbox with image filenames from the input directory."""
+    def finish_roi(self, event):
+        if self.roi_mode != "rectangle":
+            return
+        (x0, y0), _ = self.roi_points
+        x1, y1 = self.canvas_to_image(event.x, event.y)
+        self.roi_mode = None
+        self.roi_points = []
+        if abs(x1 - x0) >= 2 and abs(y1 - y0) >= 2:
+            self.reanalyze_roi([(x0, y0), (x1, y0), (x1, y1), (x0, y1)])
+        else:
+            self.redraw()
+
+    def add_roi_vertex(self, event):
+        self.focus_set()
+        if self.roi_mode != "polygon":
+            self.roi_mode = "polygon"
+            self.roi_points = []
+        self.roi_points.append(self.canvas_to_image(event.x, event.y))
+        self.draw_roi()
+        return "break"
+
+    def close_roi_polygon(self, event):
+        if self.roi_mode == "polygon" and len(self.roi_points) >= 3:
+            polygon = self.roi_points
+            self.roi_mode = None
+            self.roi_points = []
+            self.reanalyze_roi(polygon)
+
+    def cancel_roi(self, event):
+        self.roi_mode = None
+        self.roi_points = []
+        self.redraw()
+
+    def draw_roi(self):
+        """Draw the region of interest being edited."""
+        self.delete("roi")
+        if not self.roi_points:
+            return
+        points = [self.image_to_canvas(x, y) for x, y in self.roi_points]
+        if self.roi_mode == "rectangle":
+            (x0, y0), (x1, y1) = points
+            self.create_rectangle(x0, y0, x1, y1, outline="orange", dash=(4, 2), tags="roi")
+        elif len(points) > 1:
+            self.create_line(*points, fill="orange", dash=(4, 2), tags="roi")
+
+    def edit_roi_params(self, event):
+        """Let the user override the segmentation parameters used for the next regions of interest."""
+        current = json.dumps(self.roi_params or DEFAULT_SEGMENTATION)
+        answer = askstring("ROI parameters", "Segmentation parameters (JSON), empty for defaults:", initialvalue=current)
+        if answer is None:
+            return
+        try:
+            self.roi_params = json.loads(answer) if answer.strip() else None
+        except ValueError as e:
+            showerror("Error", f"Invalid parameters: {e}")
+
+    def reanalyze_roi(self, polygon):
+        """Re-segment only the region of interest and splice its ellipses into the current set."""
+        if self.on_roi is None:
+            self.redraw()
+            return
+        try:
+            new_ellipses = self.on_roi(polygon, self.roi_params)
+        except Exception as e:
+            showerror("Error", f"Could not analyse region: {str(e)}")
+            self.redraw()
+            return
+        self.replace_in_roi(polygon, new_ellipses)
+
+class HistogramPanel(Canvas):
+    """Live grain-size histogram and summary for the image in the viewer."""
+
+    def show_stats(self, stats):
+        self.delete("all")
+        width = self.winfo_width() or int(self["width"])
+        height = self.winfo_height() or int(self["height"])
+        plot_height = height - 40
+
+        tallest = max(stats.histogram) or 1
+        bar_width = width / len(stats.histogram)
+        for i, count in enumerate(stats.histogram):
+            bar_height = plot_height * count / tallest
+            self.create_rectangle(
+                i * bar_width, plot_height - bar_height, (i + 1) * bar_width, plot_height,
+                fill="#00447c", outline="white",
+            )
+
+        summary = stats.summary()
+        self.create_text(
+            5, height - 20, anchor="w",
+            text=f"n={summary['count']}  mean={summary['mean']:.3f}  D10={summary['d10']:.3f}  "
+                 f"D50={summary['d50']:.3f}  D90={summary['d90']:.3f} mm  (0-{stats.display_max_mm:.2f} mm)",
+        )
+
+class VirtualImageList(Frame):
+    """Image list that only draws the rows in view and builds thumbnails in the background."""
+
+    row_height = 64
+
+    def __init__(self, parent, on_select, cache=None, measurements=None, **kwargs):
+        super().__init__(parent, **kwargs)
+        self.on_select = on_select
+        self.cache = cache or ThumbnailCache()
+        self.measurements = measurements if measurements is not None else load_measurements()
+        self.files = []
+        self.selected = None
+        self.top = 0
+        self.visible = set()
+
+        # Tk objects may only be touched from the main thread, so loaders hand back paths through a queue
+        self.photos = OrderedDict()
+        self.max_photos = 512
+        self.requests = queue.LifoQueue()
+        self.requested = set()
+        self.loaded = queue.Queue()
+
+        self.canvas = Canvas(self, width=360, bg="white", highlightthickness=0)
+        self.scrollbar = Scrollbar(self, orient=VERTICAL, command=self.scroll)
+        self.scrollbar.pack(side=RIGHT, fill=Y)
+        self.canvas.pack(side="left", fill="y", expand=True)
+
+        self.canvas.bind("<Configure>", lambda event: self.render())
+        self.canvas.bind("<MouseWheel>", self.wheel)
+        self.canvas.bind("<ButtonPress-1>", self.click)
+
+        for _ in range(2):
+            threading.Thread(target=self.load_thumbnails, daemon=True).start()
+        self.after(50, self.poll_thumbnails)
+
+    def set_files(self, files):
+        """Replace the listed files with a list of (name, path) pairs."""
+        self.files = files
+        self.selected = None
+        self.top = 0
+        self.render()
+
+    def scroll(self, *args):
+        """Handle scrollbar drags and arrow clicks."""
+        view_height = self.canvas.winfo_height()
+        total_height = len(self.files) * self.row_height
+        if args[0] == "moveto":
+            self.top = float(args[1]) * total_height
+        elif args[0] == "scroll":
+            step = view_height if args[2] == "pages" else self.row_height
+            self.top += int(args[1]) * step
+        self.top = max(0, min(self.top, total_height - view_height))
+        self.render()
+
+    def wheel(self, event):
+        self.scroll("scroll", -1 if event.delta > 0 else 1, "units")
+
+    def click(self, event):
+        row = int((event.y + self.top) // self.row_height)
+        if 0 <= row < len(self.files):
+            self.selected = row
+            self.render()
+            self.on_select(self.files[row][0])
+
+    def render(self):
+        """Draw the rows currently in view."""
+        self.canvas.delete("all")
+        view_height = max(1, self.canvas.winfo_height())
+        view_width = self.canvas.winfo_width()
+        total_height = max(1, len(self.files) * self.row_height)
+
+        first = int(self.top // self.row_height)
+        last = min(len(self.files), int((self.top + view_height) // self.row_height) + 1)
+        self.visible = {path for _, path in self.files[first:last]}
+
+        for row in range(first, last):
+            name, path = self.files[row]
+            y = row * self.row_height - self.top
+
+            if row == self.selected:
+                self.canvas.create_rectangle(0, y, view_width, y + self.row_height, fill="#cce0ff", outline="")
+
+            photo = self.photos.get(path)
+            if photo is not None:
+                self.photos.move_to_end(path)
+                self.canvas.create_image(5, y + self.row_height / 2, image=photo, anchor="w")
+            else:
+                self.canvas.create_rectangle(5, y + 5, 101, y + 59, outline="#cccccc")
+                if path not in self.requested:
+                    self.requested.add(path)
+                    self.requests.put(path)
+
+            self.canvas.create_text(110, y + 20, text=name, anchor="w")
+            measurement = self.measurements.get(os.path.abspath(path))
+            if measurement:
+                count, d50 = measurement
+                self.canvas.create_text(110, y + 42, text=f"{count} grains, D50 {d50:.3f} mm", anchor="w", fill="#555555")
+
+        self.scrollbar.set(self.top / total_height, min(1, (self.top + view_height) / total_height))
+
+    def load_thumbnails(self):
+        """Background loop building thumbnails, most recently requested first."""
+        while True:
+            path = self.requests.get()
+            if path not in self.visible:
+                # Scrolled out of view before we got to it; it will be requested again if needed
+                self.requested.discard(path)
+                continue
+            try:
+                self.loaded.put((path, self.cache.build(path)))
+            except Exception:
+                self.loaded.put((path, None))
+
+    def poll_thumbnails(self):
+        """Move finished thumbnails into Tk images and redraw."""
+        changed = False
+        while not self.loaded.empty():
+            path, thumbnail_path = self.loaded.get()
+            if thumbnail_path is None:
+                continue
+            self.photos[path] = ImageTk.PhotoImage(Image.open(thumbnail_path))
+            while len(self.photos) > self.max_photos:
+                evicted, _ = self.photos.popitem(last=False)
+                self.requested.discard(evicted)
+            changed = True
+        if changed:
+            self.render()
+        self.after(50, self.poll_thumbnails)
+
+def browse_images(browser):
+    """Populate the image browser with image files from the input directory."""
     directory = "./data/input/"
     try:
-        images = [
-            f
-            for f in os.listdir(directory)
-            if f.lower().endswith((".png", ".jpg", ".jpeg", ".bmp", ".gif"))
-        ]
+        images = [(os.path.basename(path), path) for path in select_images(directory)]
         if not images:
             raise FileNotFoundError("No images found in the directory.")
-        for img in images:
-            listbox.insert("end", img)
+        browser.set_files(images)
     except Exception as e:
         showerror("Error", str(e))
 
@@ -158,13 +501,8 @@ def scale_image(img, width=960):
     height = int(float(img.size[1]) * w_percent)
     return img.resize((width, height), Image.Resampling.LANCZOS)
 
-def display_image(event, listbox, canvas, get_elipses):
+def display_image(file_name, canvas, get_elipses):
     """Display the selected image with ellipses drawn on it."""
-    selected = listbox.curselection()
-    if not selected:
-        return
-
-    file_name = listbox.get(selected[0])
     file_path = os.path.join("./data/input/", file_name)
 
     try:
@@ -177,7 +515,10 @@ def display_image(event, listbox, canvas, get_elipses):
         ellipses = get_elipses(file_path, calibration_factor, max_length_mm)
         scale_factor = img.width / original_image_width
 
-        canvas.set_image(img, ellipses, scale_factor)
+        canvas.set_image(img, ellipses, scale_factor, calibration_factor, max_length_mm, load_delta(file_name))
+        canvas.on_roi = lambda polygon, params: get_elipses_roi(
+            load_image(file_path), polygon, calibration_factor, max_length_mm, params
+        )
 
     except Exception as e:
         showerror("Error", f"Could not process image: {str(e)}")
@@ -0,0 +1,362 @@
+import os
+import csv
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+import multiprocessing
+import numpy as np
+from process import get_elipses, load_json
+from multires import get_elipses_multires
+from quality import preflight
+from catalog import open_catalog, select_images, sync_status
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    path TEXT PRIMARY KEY,
+    status TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_expires);
+CREATE INDEX IF NOT EXISTS jobs_pending ON jobs (status, path);
+CREATE TABLE IF NOT EXISTS results (
+    path TEXT PRIMARY KEY,
+    count INTEGER NOT NULL,
+    average REAL NOT NULL,
+    d50 REAL NOT NULL,
+    grain_lengths TEXT NOT NULL,
+    ellipses TEXT NOT NULL,
+    worker TEXT,
+    finished REAL
+);
+CREATE TABLE IF NOT EXISTS quality (
+    path TEXT PRIMARY KEY,
+    passed INTEGER NOT NULL,
+    reasons TEXT NOT NULL,
+    metrics TEXT NOT NULL
+);
+"""
+
+def connect(db_path):
+    """Open the queue database in autocommit mode so transactions are explicit.
+
+    The default rollback journal is kept on purpose: WAL mode is not safe when the
+    database lives on a filesystem shared between hosts.
+    """
+    conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    conn.executescript(SCHEMA)
+    return conn
+
+def worker_name():
+    """Identify this worker process across hosts sharing the queue."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def enqueue(conn, paths):
+    """Add image paths to the queue, leaving already known paths untouched."""
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    conn.executemany(
+        "INSERT OR IGNORE INTO jobs (path, updated) VALUES (?, ?)",
+        [(path, now) for path in paths],
+    )
+    conn.execute("COMMIT")
+
+def enqueue_directory(conn, directory, **filters):
+    """Queue the catalogued images of a directory matching the catalog filters."""
+    paths = select_images(directory, **filters)
+    enqueue(conn, paths)
+    return len(paths)
+
+def claim(conn, owner, lease_seconds=300, max_attempts=3):
+    """Lease the next pending (or abandoned) job to a worker and return its path, or None when idle."""
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Jobs whose lease ran out too many times are given up on
+        conn.execute(
+            "UPDATE jobs SET status = 'failed', owner = NULL, error = COALESCE(error, 'lease expired'), updated = ? "
+            "WHERE status = 'running' AND lease_expires < ? AND attempts >= ?",
+            (now, now, max_attempts),
+        )
+        # Two indexed lookups, so the write lock is held for microseconds however long the queue is
+        row = conn.execute(
+            "SELECT path FROM jobs WHERE status = 'pending' ORDER BY path LIMIT 1"
+        ).fetchone() or conn.execute(
+            "SELECT path FROM jobs WHERE status = 'running' AND lease_expires < ? ORDER BY lease_expires LIMIT 1",
+            (now,),
+        ).fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+        conn.execute(
+            "UPDATE jobs SET status = 'running', owner = ?, lease_expires = ?, attempts = attempts + 1, updated = ? "
+            "WHERE path = ?",
+            (owner, now + lease_seconds, now, row[0]),
+        )
+        conn.execute("COMMIT")
+        return row[0]
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def pid_alive(pid):
+    """Check whether a process with this id is running on the local host."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def release_orphans(conn):
+    """Put back jobs leased by workers of this host that are no longer running, so restarts resume at once."""
+    host = socket.gethostname()
+    orphans = []
+    for path, owner in conn.execute("SELECT path, owner FROM jobs WHERE status = 'running'").fetchall():
+        owner_host, _, pid = owner.rpartition(":")
+        if owner_host == host and pid.isdigit() and not pid_alive(int(pid)):
+            orphans.append((time.time(), path, owner))
+
+    conn.executemany(
+        "UPDATE jobs SET status = 'pending', owner = NULL, lease_expires = NULL, updated = ? "
+        "WHERE path = ? AND owner = ? AND status = 'running'",
+        orphans,
+    )
+    return len(orphans)
+
+def heartbeat(conn, path, owner, lease_seconds=300):
+    """Extend a lease; returns False if the job was taken over by another worker."""
+    now = time.time()
+    cursor = conn.execute(
+        "UPDATE jobs SET lease_expires = ?, updated = ? WHERE path = ? AND owner = ? AND status = 'running'",
+        (now + lease_seconds, now, path, owner),
+    )
+    return cursor.rowcount == 1
+
+def record_quality(conn, path, passed, metrics, reasons):
+    conn.execute(
+        "INSERT OR REPLACE INTO quality (path, passed, reasons, metrics) VALUES (?, ?, ?, ?)",
+        (path, int(passed), json.dumps(reasons), json.dumps(metrics)),
+    )
+
+def reject(conn, path, owner, metrics, reasons):
+    """Mark a job as rejected by the pre-flight check and record why; returns False if the lease was lost."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cursor = conn.execute(
+            "UPDATE jobs SET status = 'rejected', owner = NULL, lease_expires = NULL, error = ?, updated = ? "
+            "WHERE path = ? AND owner = ? AND status = 'running'",
+            ("; ".join(reasons), time.time(), path, owner),
+        )
+        if cursor.rowcount != 1:
+            conn.execute("ROLLBACK")
+            return False
+        record_quality(conn, path, False, metrics, reasons)
+        conn.execute("COMMIT")
+        return True
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def complete(conn, path, owner, ellipses, calibration_factor, metrics=None):
+    """Store a measurement and mark its job done in one transaction; returns False if the lease was lost."""
+    grain_lengths = [ellipse[4] * calibration_factor for ellipse in ellipses]
+    now = time.time()
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cursor = conn.execute(
+            "UPDATE jobs SET status = 'done', owner = NULL, lease_expires = NULL, error = NULL, updated = ? "
+            "WHERE path = ? AND owner = ? AND status = 'running'",
+            (now, path, owner),
+        )
+        if cursor.rowcount != 1:
+            conn.execute("ROLLBACK")
+            return False
+        conn.execute(
+            "INSERT OR REPLACE INTO results (path, count, average, d50, grain_lengths, ellipses, worker, finished) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                path,
+                len(grain_lengths),
+                float(np.mean(grain_lengths)) if grain_lengths else 0,
+                float(np.median(grain_lengths)) if grain_lengths else 0,
+                json.dumps(grain_lengths),
+                json.dumps([[float(v) for v in ellipse] for ellipse in ellipses]),
+                owner,
+                now,
+            ),
+        )
+        if metrics is not None:
+            record_quality(conn, path, True, metrics, [])
+        conn.execute("COMMIT")
+        return True
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def fail(conn, path, owner, error, max_attempts=3):
+    """Release a job after an error, putting it back in the queue until it runs out of attempts."""
+    conn.execute(
+        "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+        "owner = NULL, lease_expires = NULL, error = ?, updated = ? WHERE path = ? AND owner = ?",
+        (max_attempts, error, time.time(), path, owner),
+    )
+
+def progress(conn):
+    """Count jobs per status."""
+    return dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+def run_with_heartbeat(conn_path, path, owner, lease_seconds, work):
+    """Run work() while a background thread keeps the job's lease alive."""
+    stop = threading.Event()
+
+    def beat():
+        # sqlite connections cannot be shared across threads, so the heartbeat opens its own
+        beat_conn = connect(conn_path)
+        try:
+            while not stop.wait(lease_seconds / 3):
+                if not heartbeat(beat_conn, path, owner, lease_seconds):
+                    break
+        finally:
+            beat_conn.close()
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        return work()
+    finally:
+        stop.set()
+        thread.join()
+
+def run_worker(db_path, calibration_factor, max_length_mm, lease_seconds=300, max_attempts=3, measure=get_elipses,
+               thresholds=None, check_quality=True):
+    """Pull and measure images until the queue is drained; returns the number of images completed.
+
+    Unless check_quality is False, frames failing the pre-flight thresholds are
+    rejected before segmentation.
+    """
+    owner = worker_name()
+    conn = connect(db_path)
+    done = 0
+
+    try:
+        while True:
+            path = claim(conn, owner, lease_seconds, max_attempts)
+            if path is None:
+                break
+            metrics = None
+            if check_quality:
+                passed, metrics, reasons = preflight(path, thresholds)
+                if not passed:
+                    reject(conn, path, owner, metrics, reasons)
+                    continue
+            try:
+                ellipses = run_with_heartbeat(
+                    db_path, path, owner, lease_seconds,
+                    lambda: measure(path, calibration_factor, max_length_mm),
+                )
+            except Exception as e:
+                fail(conn, path, owner, str(e), max_attempts)
+                continue
+            if complete(conn, path, owner, ellipses, calibration_factor, metrics):
+                done += 1
+    finally:
+        conn.close()
+
+    return done
+
+def run_workers(db_path, workers, calibration_factor, max_length_mm, lease_seconds=300, max_attempts=3,
+                thresholds=None, check_quality=True, measure=get_elipses):
+    """Start several local worker processes on the same queue and wait for them."""
+    conn = connect(db_path)
+    release_orphans(conn)
+    conn.close()
+
+    processes = [
+        multiprocessing.Process(
+            target=run_worker,
+            args=(db_path, calibration_factor, max_length_mm, lease_seconds, max_attempts, measure,
+                  thresholds, check_quality),
+        )
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+def export_csv(conn, csv_path):
+    """Write finished measurements in the same file/average/count layout as the batch scripts.
+
+    Frames rejected by the pre-flight check are listed with a zero count and the reasons.
+    """
+    rows = conn.execute(
+        "SELECT jobs.path, results.average, results.count, results.d50, quality.reasons FROM jobs "
+        "LEFT JOIN results ON results.path = jobs.path LEFT JOIN quality ON quality.path = jobs.path "
+        "WHERE jobs.status IN ('done', 'rejected') ORDER BY jobs.path"
+    )
+    with open(csv_path, "w", newline="") as csvfile:
+        csvwriter = csv.writer(csvfile)
+        csvwriter.writerow(["file", "average", "count", "d50", "rejected"])
+        for path, average, count, d50, reasons in rows:
+            reasons = json.loads(reasons) if reasons else []
+            csvwriter.writerow([os.path.basename(path), average or 0, count or 0, d50 or 0, "; ".join(reasons)])
+
+def main():
+    parser = argparse.ArgumentParser(description="Resumable grain measurement queue shared between workers.")
+    parser.add_argument("--db", default="./data/jobs.sqlite", help="Queue database, on a filesystem shared by all workers")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    init_parser = commands.add_parser("init", help="Queue every image in a directory")
+    init_parser.add_argument("directory", nargs="?", default="./data/input/")
+    init_parser.add_argument("--core-prefix", help="Only queue cores whose ID starts with this")
+    init_parser.add_argument("--since", help="Only images captured at or after this time, e.g. '2024-01-25 05:00'")
+    init_parser.add_argument("--until", help="Only images captured at or before this time")
+
+    work_parser = commands.add_parser("work", help="Measure queued images until none are left")
+    work_parser.add_argument("--workers", type=int, default=1)
+    work_parser.add_argument("--calibration-factor", type=float, default=0.0039016750486215255)
+    work_parser.add_argument("--max-length-mm", type=float, default=0.4)
+    work_parser.add_argument("--lease-seconds", type=float, default=300)
+    work_parser.add_argument("--max-attempts", type=int, default=3)
+    work_parser.add_argument("--no-preflight", action="store_true", help="Segment every frame, even unusable ones")
+    work_parser.add_argument("--thresholds", help="JSON (inline or file) overriding quality.DEFAULT_THRESHOLDS")
+    work_parser.add_argument("--multires", action="store_true", help="Measure with the coarse-to-fine detector")
+
+    commands.add_parser("status", help="Show job counts per status")
+
+    export_parser = commands.add_parser("export", help="Write finished results to a CSV file")
+    export_parser.add_argument("csv_path", nargs="?", default="./data/queue-results.csv")
+
+    args = parser.parse_args()
+    conn = connect(args.db)
+
+    if args.command == "init":
+        count = enqueue_directory(conn, args.directory, core_prefix=args.core_prefix, since=args.since, until=args.until)
+        print(f"Queued {count} images")
+    elif args.command == "work":
+        run_workers(
+            args.db, args.workers, args.calibration_factor, args.max_length_mm, args.lease_seconds, args.max_attempts,
+            thresholds=load_json(args.thresholds) if args.thresholds else None,
+            check_quality=not args.no_preflight, measure=get_elipses_multires if args.multires else get_elipses,
+        )
+        # Keep the catalog's measurement status in step with the queue
+        catalog = open_catalog()
+        sync_status(catalog, args.db)
+        catalog.close()
+    elif args.command == "export":
+        export_csv(conn, args.csv_path)
+
+    print(progress(conn))
+    conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import os
+import csv
+import json
+import sqlite3
+import argparse
+import numpy as np
+
+class GrainStats:
+    """Running grain-size statistics that support adding and removing single grains.
+
+    Sizes are counted in a Fenwick tree of ``resolution_mm`` wide bins, so every
+    update and every percentile query is O(log n) in the number of bins, while
+    count and mean are kept up to date in O(1). The display histogram spans 0 to
+    the running D99 rounded up to ``display_step_mm``, so it follows the grains
+    actually present rather than the ``max_length_mm`` limit.
+    """
+
+    def __init__(self, max_length_mm=4, resolution_mm=0.001, num_bins=40, grain_lengths=(), display_step_mm=0.01):
+        self.max_length_mm = max_length_mm
+        self.resolution_mm = resolution_mm
+        self.size = int(max_length_mm / resolution_mm) + 1
+        self.tree = [0] * (self.size + 1)
+        self.count = 0
+        self.total = 0.0
+        self.num_bins = num_bins
+        self.display_step_mm = display_step_mm
+        for length in grain_lengths:
+            self.add(length)
+
+    def fine_bin(self, length_mm):
+        return min(self.size - 1, max(0, int(length_mm / self.resolution_mm)))
+
+    def update(self, length_mm, delta):
+        i = self.fine_bin(length_mm) + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+        self.count += delta
+        self.total += delta * length_mm
+
+    def add(self, length_mm):
+        self.update(length_mm, 1)
+
+    def remove(self, length_mm):
+        self.update(length_mm, -1)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def percentile(self, q):
+        """Grain size (mm) below which a fraction q of the grains fall, to bin resolution."""
+        if not self.count:
+            return 0
+        rank = max(1, int(round(q * self.count)))
+
+        # Walk down the tree to the first bin whose cumulative count reaches the rank
+        position = 0
+        step = 1 << self.size.bit_length()
+        while step:
+            if position + step <= self.size and self.tree[position + step] < rank:
+                position += step
+                rank -= self.tree[position]
+            step >>= 1
+        return (position + 0.5) * self.resolution_mm
+
+    def count_below(self, fine_bin):
+        """Number of grains in the fine bins before ``fine_bin``."""
+        i = min(fine_bin, self.size)
+        count = 0
+        while i > 0:
+            count += self.tree[i]
+            i -= i & -i
+        return count
+
+    @property
+    def display_max_mm(self):
+        """Upper end of the display histogram: the D99 rounded up to a display step."""
+        steps = max(1, int(np.ceil(self.percentile(0.99) / self.display_step_mm)))
+        return min(self.max_length_mm, steps * self.display_step_mm)
+
+    @property
+    def histogram(self):
+        """Grain counts in ``num_bins`` equal bins from 0 to display_max_mm; the last bin also holds larger grains."""
+        fine_bins = max(1, int(np.ceil(self.display_max_mm / self.resolution_mm / self.num_bins)))
+        edges = [self.count_below(i * fine_bins) for i in range(self.num_bins)] + [self.count]
+        return [high - low for low, high in zip(edges, edges[1:])]
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "d10": self.percentile(0.1),
+            "d50": self.percentile(0.5),
+            "d90": self.percentile(0.9),
+        }
+
+def edit_path(file_name, edits_dir="./data/edits/"):
+    """Where the manual edits for an image are stored."""
+    return os.path.join(edits_dir, f"{os.path.splitext(os.path.basename(file_name))[0]}.json")
+
+def new_delta(file_name):
+    return {"file": os.path.basename(file_name), "removed": [], "added": []}
+
+def load_delta(file_name, edits_dir="./data/edits/"):
+    """Load the saved edits for an image, or an empty delta."""
+    path = edit_path(file_name, edits_dir)
+    if not os.path.exists(path):
+        return new_delta(file_name)
+    with open(path) as f:
+        return json.load(f)
+
+def save_delta(delta, edits_dir="./data/edits/"):
+    """Atomically write the edits for an image."""
+    os.makedirs(edits_dir, exist_ok=True)
+    path = edit_path(delta["file"], edits_dir)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(delta, f, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+def ellipse_key(ellipse):
+    """Identify an automatic ellipse by its centre, rounded to a tenth of a pixel."""
+    return [round(float(ellipse[0]), 1), round(float(ellipse[1]), 1)]
+
+def matches(ellipse, key, tolerance=0.5):
+    return abs(ellipse[0] - key[0]) <= tolerance and abs(ellipse[1] - key[1]) <= tolerance
+
+def apply_delta(ellipses, delta):
+    """Apply saved edits to an automatic result.
+
+    Removed ellipses are matched by centre rather than index, so a delta made in the
+    viewer also applies to batch results produced with a different size limit.
+    """
+    kept = [e for e in ellipses if not any(matches(e, key) for key in delta["removed"])]
+    return kept + [list(e) for e in delta["added"]]
+
+def regenerate_results(db_path, csv_path, calibration_factor, max_length_mm=0.4, edits_dir="./data/edits/"):
+    """Rewrite the per-image results of the job queue with manual edits applied, without re-segmenting.
+
+    ``max_length_mm`` is the batch size limit; ellipses added in the viewer, which
+    uses its own limit, are dropped above it.
+    """
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute("SELECT path, ellipses FROM results ORDER BY path").fetchall()
+    conn.close()
+
+    with open(csv_path, "w", newline="") as csvfile:
+        csvwriter = csv.writer(csvfile)
+        csvwriter.writerow(["file", "average", "count", "d50", "edited"])
+        for path, ellipses in rows:
+            ellipses = json.loads(ellipses)
+            edited = os.path.exists(edit_path(path, edits_dir))
+            if edited:
+                delta = load_delta(path, edits_dir)
+                delta["added"] = [e for e in delta["added"] if e[4] * calibration_factor <= max_length_mm]
+                ellipses = apply_delta(ellipses, delta)
+
+            # Same statistics as the job queue, so unedited images keep their original values
+            grain_lengths = np.array([ellipse[4] * calibration_factor for ellipse in ellipses])
+            csvwriter.writerow([
+                os.path.basename(path),
+                float(np.mean(grain_lengths)) if len(grain_lengths) else 0,
+                len(grain_lengths),
+                float(np.median(grain_lengths)) if len(grain_lengths) else 0,
+                edited,
+            ])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Regenerate batch results with the edits made in the viewer.")
+    parser.add_argument("--db", default="./data/jobs.sqlite")
+    parser.add_argument("--edits", default="./data/edits/")
+    parser.add_argument("--calibration-factor", type=float, default=0.0039016750486215255)
+    parser.add_argument("--max-length-mm", type=float, default=0.4, help="Size limit the batch results were measured with")
+    parser.add_argument("csv_path", nargs="?", default="./data/edited-results.csv")
+    args = parser.parse_args()
+    regenerate_results(args.db, args.csv_path, args.calibration_factor, args.max_length_mm, args.edits)
@@ -0,0 +1,303 @@
+import time
+import cv2
+import numpy as np
+from process import segmentation_params, segment_image, get_filtered_contours, analyze_contours, get_elipses_from_image
+
+def downsample_image(image, factor):
+    """Shrink an image by an integer factor.
+
+    Bilinear resizing averages the 2x2 pixels around each sample's centre, which is
+    an order of magnitude cheaper than full area averaging at the same factor.
+    """
+    height, width = image.shape[:2]
+    return cv2.resize(image, (max(1, width // factor), max(1, height // factor)), interpolation=cv2.INTER_LINEAR)
+
+def to_full_resolution(ellipse, factor):
+    """Map an ellipse fitted on a downsampled image back to full-resolution pixel coordinates."""
+    x_pos, y_pos, angle, major_axis, minor_axis = ellipse
+    return [(x_pos + 0.5) * factor - 0.5, (y_pos + 0.5) * factor - 0.5, angle, major_axis * factor, minor_axis * factor]
+
+def is_ambiguous(contour, ellipse, tolerance):
+    """Check whether a contour is poorly described by its fitted ellipse (merged or ragged grains)."""
+    _, (major_axis, minor_axis), _ = ellipse
+    ellipse_area = np.pi * major_axis * minor_axis / 4
+    if ellipse_area <= 0:
+        return True
+    return abs(cv2.contourArea(contour) / ellipse_area - 1) > tolerance
+
+def coarse_pass(small, factor, calibration_factor, max_length_mm, params, min_grain_px, edge_tolerance):
+    """Segment the downsampled image and split its grains into accepted ellipses and regions needing refinement."""
+    binary = segment_image(small, params)
+    contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    accepted = []
+    refine_mask = np.zeros(binary.shape, dtype=np.uint8)
+    claimed_mask = np.zeros(binary.shape, dtype=np.uint8)
+
+    for contour in contours:
+        if len(contour) < 5:
+            # Too small to fit at this scale, it may still be a grain at full resolution
+            cv2.drawContours(refine_mask, [contour], -1, 255, cv2.FILLED)
+            continue
+        try:
+            ellipse = cv2.fitEllipse(contour)
+        except cv2.error:
+            cv2.drawContours(refine_mask, [contour], -1, 255, cv2.FILLED)
+            continue
+
+        # Grains cut by the image border are partial ellipses at every scale, so only their size is checked
+        x, y, w, h = cv2.boundingRect(contour)
+        at_border = x == 0 or y == 0 or x + w == binary.shape[1] or y + h == binary.shape[0]
+        _, (_, minor_axis), _ = ellipse
+        if minor_axis * factor < min_grain_px or (not at_border and is_ambiguous(contour, ellipse, edge_tolerance)):
+            cv2.rectangle(refine_mask, (x, y), (x + w - 1, y + h - 1), 255, cv2.FILLED)
+            continue
+
+        (x_pos, y_pos), (major_axis, minor_axis), angle = ellipse
+        if minor_axis * factor * calibration_factor <= max_length_mm:
+            accepted.append(to_full_resolution([x_pos, y_pos, angle, major_axis, minor_axis], factor))
+        cv2.drawContours(claimed_mask, [contour], -1, 255, cv2.FILLED)
+
+    return binary, accepted, refine_mask, claimed_mask
+
+def lost_grain_mask(small, binary, params, edge_margin):
+    """Flag pixels just above the gray threshold that are not next to any coarse grain.
+
+    Grains narrower than a coarse pixel are averaged with the bright matrix around
+    them and end up slightly brighter than the threshold instead of below it.
+    """
+    params = segmentation_params(params)
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    threshold = params["threshold"]
+    near = cv2.inRange(gray, threshold + 1, min(255, threshold + edge_margin))
+    near_grains = cv2.dilate(binary, np.ones((3, 3), np.uint8))
+    return cv2.bitwise_and(near, cv2.bitwise_not(near_grains))
+
+def refine_crops(refine_mask, factor, tile):
+    """Full-resolution boxes around the refinement pixels of each tile.
+
+    Each box is clipped to its tile, so boxes never overlap and their total area is
+    bounded by the image; a tile only owns grains whose centre lies inside it.
+    """
+    crops = []
+    for ty in range(0, refine_mask.shape[0], tile):
+        for tx in range(0, refine_mask.shape[1], tile):
+            x, y, w, h = cv2.boundingRect(refine_mask[ty:ty + tile, tx:tx + tile])
+            if not w:
+                continue
+            crops.append((
+                (tx, ty, tx + tile, ty + tile),
+                ((tx + x) * factor, (ty + y) * factor, (tx + x + w) * factor, (ty + y + h) * factor),
+            ))
+    return crops
+
+def refine_regions(image, crops, refine_mask, claimed_mask, factor, calibration_factor, max_length_mm, params, pad):
+    """Re-segment each box, grown by ``pad``, at full resolution and keep the grains its tile owns.
+
+    When the outline of a grain cut by the crop border runs through unclaimed
+    refinement pixels of the tile, the grain may be owned by the tile, so the pad is doubled and the crop segmented
+    again; grains are only ever measured whole.
+    """
+    height, width = image.shape[:2]
+    open_mask = cv2.bitwise_and(refine_mask, cv2.bitwise_not(claimed_mask))
+    refined = []
+
+    for (tx0, ty0, tx1, ty1), (rx0, ry0, rx1, ry1) in crops:
+        crop_pad = pad
+        while True:
+            x0, y0 = max(0, rx0 - crop_pad), max(0, ry0 - crop_pad)
+            x1, y1 = min(width, rx1 + crop_pad), min(height, ry1 + crop_pad)
+            contours = []
+            cut = False
+            for contour in get_filtered_contours(segment_image(image[y0:y1, x0:x1], params)):
+                # Grains cut by the crop border (but not by the image border) are not measured here
+                bx, by, bw, bh = cv2.boundingRect(contour)
+                if (bx == 0 and x0 > 0) or (by == 0 and y0 > 0) or \
+                        (bx + bw == x1 - x0 and x1 < width) or (by + bh == y1 - y0 and y1 < height):
+                    if not cut:
+                        points = (contour[:, 0, :] + (x0, y0)) // factor
+                        points = np.minimum(points, (open_mask.shape[1] - 1, open_mask.shape[0] - 1))
+                        in_tile = (points[:, 0] >= tx0) & (points[:, 0] < tx1) & (points[:, 1] >= ty0) & (points[:, 1] < ty1)
+                        cut = bool(open_mask[points[in_tile, 1], points[in_tile, 0]].any())
+                    continue
+                contours.append(contour)
+            if not cut:
+                break
+            crop_pad *= 2
+
+        for x_pos, y_pos, angle, major_axis, minor_axis in analyze_contours(contours, max_length_mm, calibration_factor):
+            x_pos, y_pos = x_pos + x0, y_pos + y0
+
+            # Only keep grains centred in a refinement region of this tile and not covered by an accepted coarse grain
+            cx = min(refine_mask.shape[1] - 1, int(x_pos // factor))
+            cy = min(refine_mask.shape[0] - 1, int(y_pos // factor))
+            if not (tx0 <= cx < tx1 and ty0 <= cy < ty1) or not open_mask[cy, cx]:
+                continue
+            refined.append([x_pos, y_pos, angle, major_axis, minor_axis])
+
+    return refined
+
+def mostly_small_grains(image, params, min_grain_px, max_small_fraction, stride=8):
+    """Tell from a strided preview whether most grains are narrower than ``min_grain_px``.
+
+    Such grains would all be re-processed at full resolution, so the coarse pass
+    cannot pay off. The preview costs a few percent of a full-resolution pass.
+    """
+    preview = np.ascontiguousarray(image[::stride, ::stride])
+    contours, _ = cv2.findContours(segment_image(preview, params), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return False
+
+    widths = np.array([min(cv2.boundingRect(contour)[2:]) for contour in contours])
+    return np.mean(widths * stride < min_grain_px) > max_small_fraction
+
+def get_elipses_multires_from_image(image, calibration_factor, max_length_mm, params=None, factor=4,
+                                    min_grain_px=32, edge_tolerance=0.25, edge_margin=16, max_refine_fraction=0.4,
+                                    tile_px=512, max_small_fraction=0.5):
+    """Coarse-to-fine ellipse detection on an already decoded image.
+
+    Grains are segmented and fitted on an image downsampled by ``factor``. Only grains
+    whose minor axis is below ``min_grain_px`` full-resolution pixels, grains whose
+    contour deviates from its ellipse by more than ``edge_tolerance`` in area, and
+    faint spots that may hide sub-pixel grains are re-processed at full resolution,
+    in crops grouped per ``tile_px`` tile.
+    Every grain kept from the coarse pass is therefore at least ``min_grain_px`` wide
+    and its minor axis carries at most ``factor`` pixels of quantisation error, i.e.
+    a relative error of at most ``factor / min_grain_px`` (see check_accuracy). This
+    assumes neighbouring grains are more than ``factor`` pixels apart; closer grains
+    can merge in the coarse pass and are only split again when the merged outline
+    fails ``edge_tolerance``. When the crops would cover
+    more than ``max_refine_fraction`` of the image the full-resolution path is used
+    instead, and so is a frame where more than ``max_small_fraction`` of the grains
+    seen in a strided preview are narrower than ``min_grain_px``; that check runs
+    before the coarse pass, so images made of small grains cost little more than before.
+    """
+    if factor <= 1 or mostly_small_grains(image, params, min_grain_px, max_small_fraction, 2 * factor):
+        return get_elipses_from_image(image, calibration_factor, max_length_mm, params)
+
+    height, width = image.shape[:2]
+    small = downsample_image(image, factor)
+    binary, accepted, refine_mask, claimed_mask = coarse_pass(
+        small, factor, calibration_factor, max_length_mm, params, min_grain_px, edge_tolerance
+    )
+    refine_mask = cv2.bitwise_or(refine_mask, lost_grain_mask(small, binary, params, edge_margin))
+    refine_mask = cv2.dilate(refine_mask, np.ones((3, 3), np.uint8))
+
+    pad = max(factor, min_grain_px // 2)
+    crops = refine_crops(refine_mask, factor, max(1, tile_px // factor))
+    crop_area = sum((x1 - x0 + 2 * pad) * (y1 - y0 + 2 * pad) for _, (x0, y0, x1, y1) in crops)
+    if crop_area > max_refine_fraction * width * height:
+        return get_elipses_from_image(image, calibration_factor, max_length_mm, params)
+
+    refined = refine_regions(
+        image, crops, refine_mask, claimed_mask, factor, calibration_factor, max_length_mm, params, pad
+    )
+    return accepted + refined
+
+def get_elipses_multires(file_path, calibration_factor, max_length_mm, params=None, **kwargs):
+    """Process an image file with the coarse-to-fine detector and return a list of filtered ellipses."""
+    image = cv2.imread(file_path)
+    if image is None:
+        raise ValueError(f"Unable to load image from path: {file_path}")
+
+    return get_elipses_multires_from_image(image, calibration_factor, max_length_mm, params, **kwargs)
+
+def compare_ellipses(reference, candidate, calibration_factor):
+    """Summarise how far a set of ellipses is from a reference set in grain count, mean and D50 (mm)."""
+    reference_mm = np.array([e[4] for e in reference]) * calibration_factor
+    candidate_mm = np.array([e[4] for e in candidate]) * calibration_factor
+
+    def relative(a, b):
+        return abs(a - b) / b if b else float(a != b)
+
+    reference_mean = reference_mm.mean() if len(reference_mm) else 0
+    candidate_mean = candidate_mm.mean() if len(candidate_mm) else 0
+    reference_d50 = np.median(reference_mm) if len(reference_mm) else 0
+    candidate_d50 = np.median(candidate_mm) if len(candidate_mm) else 0
+
+    return {
+        "count_error": relative(len(candidate_mm), len(reference_mm)),
+        "mean_error": relative(candidate_mean, reference_mean),
+        "d50_error": relative(candidate_d50, reference_d50),
+    }
+
+def synthetic_grains(width=3840, height=2160, attempts=2000, min_minor_px=40, max_minor_px=120, gap_px=8, seed=0):
+    """A dense frame of dark, separated elliptical grains on a bright matrix, for checking the coarse-to-fine mode."""
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width, 3), (200, 205, 210), dtype=np.uint8)
+    occupied = np.zeros((height, width), dtype=np.uint8)
+    candidate = np.zeros((height, width), dtype=np.uint8)
+
+    for _ in range(attempts):
+        centre = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        minor = int(rng.integers(min_minor_px, max_minor_px))
+        axes = (int(minor * rng.uniform(1, 1.8)) // 2, minor // 2)
+        angle = float(rng.uniform(0, 180))
+
+        # Keep grains apart so that they are separate contours at full resolution
+        candidate[:] = 0
+        cv2.ellipse(candidate, centre, (axes[0] + gap_px, axes[1] + gap_px), angle, 0, 360, 255, cv2.FILLED)
+        if cv2.countNonZero(cv2.bitwise_and(candidate, occupied)):
+            continue
+        cv2.ellipse(occupied, centre, axes, angle, 0, 360, 255, cv2.FILLED)
+        cv2.ellipse(image, centre, axes, angle, 0, 360, (60, 70, 80), cv2.FILLED)
+
+    return image
+
+def check_accuracy(image, calibration_factor, max_length_mm, params=None, factor=4, min_grain_px=32, **kwargs):
+    """Compare the coarse-to-fine result with the full-resolution one and assert the stated error bound.
+
+    Every coarse-to-fine grain is matched to the full-resolution grain nearest its
+    centre; matched grains at least ``min_grain_px`` wide, the ones the coarse pass may
+    keep, must agree on the minor axis within ``factor / min_grain_px`` (relative).
+    Narrower grains are measured at full resolution by both paths. Raises
+    AssertionError otherwise and returns the comparison summary.
+    """
+    reference = get_elipses_from_image(image, calibration_factor, max_length_mm, params)
+    ellipses = get_elipses_multires_from_image(
+        image, calibration_factor, max_length_mm, params, factor=factor, min_grain_px=min_grain_px, **kwargs
+    )
+    summary = compare_ellipses(reference, ellipses, calibration_factor)
+    if not reference or not ellipses:
+        summary["max_minor_error"] = 0.0 if len(reference) == len(ellipses) else float("inf")
+        assert len(reference) == len(ellipses), summary
+        return summary
+
+    reference_array = np.array(reference)
+    errors = []
+    for ellipse in ellipses:
+        distances = np.hypot(reference_array[:, 0] - ellipse[0], reference_array[:, 1] - ellipse[1])
+        nearest = reference_array[distances.argmin()]
+        # Centres further apart than half the width of either grain belong to different grains (see count_error)
+        if distances.min() > min(nearest[3], nearest[4], ellipse[3], ellipse[4]) / 2:
+            continue
+        if min(nearest[3], nearest[4]) < min_grain_px:
+            continue
+        errors.append(abs(ellipse[4] - nearest[4]) / nearest[4])
+
+    summary["matched"] = len(errors)
+    summary["max_minor_error"] = max(errors, default=0.0)
+    summary["bound"] = factor / min_grain_px
+    assert summary["max_minor_error"] <= summary["bound"], summary
+    return summary
+
+if __name__ == "__main__":
+    calibration_factor = 0.0039016750486215255
+    cases = [
+        ("233800-240125051452.jpg", cv2.imread("./data/input/233800-240125051452.jpg"), 0.4),
+        ("synthetic dense coarse grains", synthetic_grains(), 4),
+    ]
+
+    for name, image, max_length_mm in cases:
+        start = time.perf_counter()
+        reference = get_elipses_from_image(image, calibration_factor, max_length_mm)
+        full_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        ellipses = get_elipses_multires_from_image(image, calibration_factor, max_length_mm)
+        multires_time = time.perf_counter() - start
+
+        print(f"{name}:")
+        print(f"  Full resolution: {len(reference)} grains in {full_time:.3f}s")
+        print(f"  Coarse-to-fine: {len(ellipses)} grains in {multires_time:.3f}s")
+        print(f"  {check_accuracy(image, calibration_factor, max_length_mm)}")
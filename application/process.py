@@ -1,5 +1,8 @@
+import os
+import json
 import cv2
 import numpy as np
+from functools import lru_cache
 
 def get_filtered_contours(binary):
     """Get filtered contours based on a binary mask."""
@@ -25,49 +28,126 @@ def analyze_contours(contours, max_length_mm, calibration_factor):
 
     return ellipses
 
-def get_elipses(file_path, calibration_factor, max_length_mm):
-    """Process an image file to detect and return a list of filtered ellipses."""
-    # Read the image
-    image = cv2.imread(file_path)
-    if image is None:
-        raise ValueError(f"Unable to load image from path: {file_path}")
-
-    # Convert to HSV and enhance saturation
-    saturation_factor = 1
+DEFAULT_SEGMENTATION = {
+    "saturation_factor": 1,
+    "lower_cyan": (30, 100, 100),
+    "upper_cyan": (85, 255, 255),
+    "lower_red": (130, 50, 50),
+    "upper_red": (200, 255, 255),
+    "threshold": 128 + 32,
+}
+
+def segmentation_params(params=None):
+    """Complete segmentation parameters, with colour bounds given as JSON lists turned into tuples for inRange."""
+    return {
+        **DEFAULT_SEGMENTATION,
+        **{name: tuple(value) if isinstance(value, list) else value for name, value in (params or {}).items()},
+    }
+
+def segment_image(image, params=None):
+    """Segment a BGR image into a single-channel binary mask of grain candidates."""
     hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-    hsv_image[:, :, 1] = cv2.multiply(hsv_image[:, :, 1], saturation_factor)
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return segment_converted(hsv_image, gray, params)
 
-    # Create masks for cyan and red colors
-    lower_cyan = (30, 100, 100)
-    upper_cyan = (85, 255, 255)
-    lower_red = (130, 50, 50)
-    upper_red = (200, 255, 255)
+def segment_converted(hsv_image, gray, params=None):
+    """Segment from already converted HSV and grayscale images (the HSV image is not modified)."""
+    params = segmentation_params(params)
 
-    mask_cyan = cv2.inRange(hsv_image, lower_cyan, upper_cyan)
-    mask_red = cv2.inRange(hsv_image, lower_red, upper_red)
-    mask = cv2.bitwise_or(mask_cyan, mask_red)
+    # Enhance saturation
+    if params["saturation_factor"] != 1:
+        hsv_image = hsv_image.copy()
+        hsv_image[:, :, 1] = cv2.multiply(hsv_image[:, :, 1], params["saturation_factor"])
 
-    # Create color contour image
-    color_contour = cv2.bitwise_and(image, image, mask=mask)
-    color_contour[mask == 0] = [0, 0, 0]
-    color_contour[mask != 0] = [255, 255, 255]
+    # Create masks for cyan and red colors
+    mask_cyan = cv2.inRange(hsv_image, params["lower_cyan"], params["upper_cyan"])
+    mask_red = cv2.inRange(hsv_image, params["lower_red"], params["upper_red"])
+    mask = cv2.bitwise_or(mask_cyan, mask_red)
 
-    # Convert to grayscale and binary
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    _, binary = cv2.threshold(gray, 128 + 32, 255, cv2.THRESH_BINARY_INV)
+    # Threshold the grayscale image
+    _, binary = cv2.threshold(gray, params["threshold"], 255, cv2.THRESH_BINARY_INV)
 
-    # Invert the color contour
-    inverted_color_contour = cv2.bitwise_not(color_contour)
-    sharpened_binary = cv2.bitwise_and(inverted_color_contour, inverted_color_contour, mask=binary)
+    # Keep dark pixels that are not part of the cyan/red colour contour
+    return cv2.bitwise_and(cv2.bitwise_not(mask), binary)
 
-    # Convert sharpened_binary to single-channel
-    sharpened_binary_gray = cv2.cvtColor(sharpened_binary, cv2.COLOR_BGR2GRAY)
+def get_elipses_from_image(image, calibration_factor, max_length_mm, params=None):
+    """Detect and return a list of filtered ellipses from an already decoded image."""
+    sharpened_binary_gray = segment_image(image, params)
 
     # Filter contours and analyze them
     filtered_contours = get_filtered_contours(sharpened_binary_gray)
-    ellipses = analyze_contours(filtered_contours, max_length_mm, calibration_factor)
+    return analyze_contours(filtered_contours, max_length_mm, calibration_factor)
 
-    return ellipses
+def get_elipses(file_path, calibration_factor, max_length_mm, params=None):
+    """Process an image file to detect and return a list of filtered ellipses."""
+    # Read the image
+    image = cv2.imread(file_path)
+    if image is None:
+        raise ValueError(f"Unable to load image from path: {file_path}")
+
+    return get_elipses_from_image(image, calibration_factor, max_length_mm, params)
+
+@lru_cache(maxsize=2)
+def load_image(file_path):
+    """Read an image once and keep it for repeated region-of-interest analysis."""
+    image = cv2.imread(file_path)
+    if image is None:
+        raise ValueError(f"Unable to load image from path: {file_path}")
+    return image
+
+def ellipses_in_polygon(ellipses, polygon):
+    """For each ellipse, whether its centre lies inside (or on) a polygon."""
+    polygon = np.asarray(polygon, dtype=np.float32).reshape(-1, 1, 2)
+    return [cv2.pointPolygonTest(polygon, (float(e[0]), float(e[1])), False) >= 0 for e in ellipses]
+
+def get_elipses_roi(image, polygon, calibration_factor, max_length_mm, params=None, pad=64):
+    """Detect the ellipses centred inside a polygonal region of interest, in full-image coordinates.
+
+    Only the polygon's bounding box, grown by ``pad`` pixels, is segmented, so the cost
+    scales with the region rather than the image. Grains cut by the crop border (but
+    not by the image border) are left out, as in multires and stream, so a grain is
+    measured whole or not at all; when such a grain reaches into the region the pad
+    is doubled and the crop segmented again.
+    """
+    polygon = np.asarray(polygon, dtype=np.float32).reshape(-1, 1, 2)
+    height, width = image.shape[:2]
+    x, y, w, h = cv2.boundingRect(polygon)
+
+    while True:
+        x0, y0 = max(0, x - pad), max(0, y - pad)
+        x1, y1 = min(width, x + w + pad), min(height, y + h + pad)
+        if x1 <= x0 or y1 <= y0:
+            return []
+
+        contours = []
+        cut = False
+        for contour in get_filtered_contours(segment_image(image[y0:y1, x0:x1], params)):
+            bx, by, bw, bh = cv2.boundingRect(contour)
+            if (bx == 0 and x0 > 0) or (by == 0 and y0 > 0) or \
+                    (bx + bw == x1 - x0 and x1 < width) or (by + bh == y1 - y0 and y1 < height):
+                # Might be centred in the region: needs a larger crop to be measured whole
+                cut = cut or (bx + x0 < x + w and bx + bw + x0 > x and by + y0 < y + h and by + bh + y0 > y)
+                continue
+            contours.append(contour)
+        if not cut:
+            break
+        pad *= 2
+
+    ellipses = analyze_contours(contours, max_length_mm, calibration_factor)
+    ellipses = [[x_pos + x0, y_pos + y0, angle, major_axis, minor_axis] for x_pos, y_pos, angle, major_axis, minor_axis in ellipses]
+    return [ellipse for ellipse, inside in zip(ellipses, ellipses_in_polygon(ellipses, polygon)) if inside]
+
+def splice_ellipses(ellipses, new_ellipses, polygon):
+    """Replace the ellipses centred inside a polygon with new ones."""
+    inside = ellipses_in_polygon(ellipses, polygon)
+    return [ellipse for ellipse, is_inside in zip(ellipses, inside) if not is_inside] + list(new_ellipses)
+
+def load_json(value):
+    """JSON given inline or as a file path, as taken by the command-line options."""
+    if os.path.exists(value):
+        with open(value) as f:
+            return json.load(f)
+    return json.loads(value)
 
 # Example usage (commented out, for demonstration purposes only):
 if __name__ == "__main__":
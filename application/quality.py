@@ -0,0 +1,70 @@
+import cv2
+import numpy as np
+
+# Limits a frame must respect to be worth segmenting; set a limit to None to disable it.
+# Focus is the Laplacian variance of the reduced image, the other values are pixel fractions
+# or 0-255 gray levels.
+DEFAULT_THRESHOLDS = {
+    "min_focus": 20.0,
+    "min_brightness": 40,
+    "max_brightness": 235,
+    "max_overexposed": 0.2,
+    "max_underexposed": 0.2,
+    "min_grain_coverage": 0.002,
+    "max_colour_coverage": 0.5,
+}
+
+def frame_metrics(image, gray_threshold=128 + 32,
+                  colour_ranges=(((30, 100, 100), (85, 255, 255)), ((130, 50, 50), (200, 255, 255)))):
+    """Compute focus, exposure and coverage metrics of a (reduced) BGR frame."""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+
+    colour_mask = np.zeros(gray.shape, dtype=np.uint8)
+    for lower, upper in colour_ranges:
+        colour_mask = cv2.bitwise_or(colour_mask, cv2.inRange(hsv_image, lower, upper))
+
+    # One histogram answers every gray-level question
+    histogram = np.bincount(gray.ravel(), minlength=256) / gray.size
+
+    return {
+        "focus": float(cv2.Laplacian(gray, cv2.CV_64F).var()),
+        "brightness": float(np.dot(histogram, np.arange(256))),
+        "overexposed": float(histogram[250:].sum()),
+        "underexposed": float(histogram[:6].sum()),
+        "grain_coverage": float(histogram[:gray_threshold + 1].sum()),
+        "colour_coverage": cv2.countNonZero(colour_mask) / gray.size,
+    }
+
+def check_metrics(metrics, thresholds=None):
+    """Return the reasons a frame fails the thresholds (an empty list if it passes)."""
+    thresholds = {**DEFAULT_THRESHOLDS, **(thresholds or {})}
+    checks = [
+        ("min_focus", "focus", lambda value, limit: value < limit, "blurred"),
+        ("min_brightness", "brightness", lambda value, limit: value < limit, "too dark"),
+        ("max_brightness", "brightness", lambda value, limit: value > limit, "too bright"),
+        ("max_overexposed", "overexposed", lambda value, limit: value > limit, "overexposed"),
+        ("max_underexposed", "underexposed", lambda value, limit: value > limit, "underexposed"),
+        ("min_grain_coverage", "grain_coverage", lambda value, limit: value < limit, "empty"),
+        ("max_colour_coverage", "colour_coverage", lambda value, limit: value > limit, "mostly stained"),
+    ]
+    return [
+        reason
+        for limit_name, metric, fails, reason in checks
+        if thresholds[limit_name] is not None and fails(metrics[metric], thresholds[limit_name])
+    ]
+
+def preflight(file_path, thresholds=None, reduction=4):
+    """Decode a frame at reduced resolution and check it is worth segmenting.
+
+    Returns (passed, metrics, reasons). JPEGs are decoded directly at 1/2, 1/4 or
+    1/8 scale, which costs a fraction of a full decode.
+    """
+    flags = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+    image = cv2.imread(file_path, flags[reduction])
+    if image is None:
+        return False, {}, ["unreadable"]
+
+    metrics = frame_metrics(image)
+    reasons = check_metrics(metrics, thresholds)
+    return not reasons, metrics, reasons
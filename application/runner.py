@@ -0,0 +1,178 @@
+import os
+import csv
+import time
+import argparse
+import cv2
+import numpy as np
+from process import get_filtered_contours, analyze_contours, segment_converted, load_json
+from multires import get_elipses_multires_from_image
+from quality import preflight
+from catalog import select_images
+
+class SharedImage:
+    """A decoded image with its colour conversions computed at most once and shared between methods."""
+
+    def __init__(self, image):
+        self.image = image
+        self.cache = {}
+
+    def get(self, key, compute):
+        if key not in self.cache:
+            self.cache[key] = compute()
+        return self.cache[key]
+
+    @property
+    def gray(self):
+        return self.get("gray", lambda: cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY))
+
+    @property
+    def hsv(self):
+        return self.get("hsv", lambda: cv2.cvtColor(self.image, cv2.COLOR_BGR2HSV))
+
+    @property
+    def rgb(self):
+        return self.get("rgb", lambda: cv2.cvtColor(self.image, cv2.COLOR_BGR2RGB))
+
+    def saturated_hsv(self, saturation_factor):
+        """HSV image with its saturation channel scaled, shared by every method using the same factor."""
+        if saturation_factor == 1:
+            return self.hsv
+
+        def compute():
+            hsv_image = self.hsv.copy()
+            hsv_image[:, :, 1] = cv2.multiply(hsv_image[:, :, 1], saturation_factor)
+            return hsv_image
+
+        return self.get(("hsv", saturation_factor), compute)
+
+def minor_axes_mm(contours, calibration_factor, max_length_mm):
+    ellipses = analyze_contours(contours, max_length_mm, calibration_factor)
+    return [ellipse[4] * calibration_factor for ellipse in ellipses]
+
+def measure_contour(shared, calibration_factor, max_length_mm):
+    """contour.py: blurred grayscale with a fixed threshold of 128."""
+    blurred = shared.get("blurred", lambda: cv2.GaussianBlur(shared.gray, (5, 5), 0))
+    _, binary = cv2.threshold(blurred, 128, 255, cv2.THRESH_BINARY_INV)
+    return minor_axes_mm(get_filtered_contours(binary), calibration_factor, max_length_mm)
+
+def measure_color(shared, calibration_factor, max_length_mm):
+    """color.py: cyan and red HSV masks with saturation enhanced by 1.2."""
+    hsv_image = shared.saturated_hsv(1.2)
+    mask_cyan = cv2.inRange(hsv_image, (30, 100, 100), (85, 255, 255))
+    mask_red = cv2.inRange(hsv_image, (130, 50, 50), (200, 255, 255))
+    mask = cv2.bitwise_or(mask_cyan, mask_red)
+    return minor_axes_mm(get_filtered_contours(mask), calibration_factor, max_length_mm)
+
+def measure_combined(shared, calibration_factor, max_length_mm):
+    """final.py: dark pixels outside the colour masks."""
+    binary = segment_converted(shared.hsv, shared.gray)
+    return minor_axes_mm(get_filtered_contours(binary), calibration_factor, max_length_mm)
+
+def measure_combined_multires(shared, calibration_factor, max_length_mm):
+    """final.py segmentation through the coarse-to-fine detector."""
+    ellipses = get_elipses_multires_from_image(shared.image, calibration_factor, max_length_mm)
+    return [ellipse[4] * calibration_factor for ellipse in ellipses]
+
+def sam_method(checkpoint_path, model_type="vit_h"):
+    """Build a method that measures grains from Segment Anything masks (requires segment_anything)."""
+    from segment_anything import SamAutomaticMaskGenerator, sam_model_registry
+
+    generator = SamAutomaticMaskGenerator(sam_model_registry[model_type](checkpoint=checkpoint_path))
+
+    def measure_sam(shared, calibration_factor, max_length_mm):
+        grain_lengths = []
+        kernel = np.ones((3, 3), np.uint8)
+        for mask_data in generator.generate(shared.rgb):
+            binary_mask = mask_data["segmentation"].astype(np.uint8)
+            cleaned_mask = cv2.morphologyEx(binary_mask, cv2.MORPH_OPEN, kernel)
+            contours, _ = cv2.findContours(cleaned_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            for contour in contours:
+                length_mm = min(cv2.minAreaRect(contour)[1]) * calibration_factor
+                if length_mm <= max_length_mm:
+                    grain_lengths.append(length_mm)
+        return grain_lengths
+
+    return measure_sam
+
+# Method name -> (measure function, maximum minor axis in mm), as configured in each script
+METHODS = {
+    "contour": (measure_contour, 4),
+    "color": (measure_color, 3),
+    "combined": (measure_combined, 0.4),
+}
+
+def run_methods(image, methods, calibration_factor):
+    """Run every method on one decoded image and return {name: grain_lengths}."""
+    shared = SharedImage(image)
+    return {
+        name: measure(shared, calibration_factor, max_length_mm)
+        for name, (measure, max_length_mm) in methods.items()
+    }
+
+QUALITY_COLUMNS = ["focus", "brightness", "grain_coverage", "colour_coverage", "rejected"]
+
+def process_directory(paths, methods, calibration_factor, output_dir, thresholds=None):
+    """Decode each image once, run all methods on it and write their results side by side.
+
+    With thresholds given, frames are first checked at reduced resolution and those
+    failing the check are recorded with their metrics instead of being measured.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    results = []
+
+    with open(os.path.join(output_dir, "results.csv"), "w", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        header = ["file"] + [f"{name}_{column}" for name in methods for column in ("average", "count")]
+        writer.writerow(header + (QUALITY_COLUMNS if thresholds is not None else []))
+
+        for path in paths:
+            quality_row = []
+            if thresholds is not None:
+                passed, metrics, reasons = preflight(path, thresholds)
+                quality_row = [metrics.get(column, "") for column in QUALITY_COLUMNS[:-1]] + ["; ".join(reasons)]
+                if not passed:
+                    writer.writerow([os.path.basename(path)] + [""] * (len(header) - 1) + quality_row)
+                    continue
+
+            image = cv2.imread(path)
+            if image is None:
+                print(f"Skipping unreadable image: {path}")
+                continue
+
+            lengths = run_methods(image, methods, calibration_factor)
+            row = [os.path.basename(path)]
+            for name in methods:
+                row += [np.mean(lengths[name]) if lengths[name] else 0, len(lengths[name])]
+            writer.writerow(row + quality_row)
+            results.append((os.path.basename(path), lengths))
+
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run several grain measurement methods in a single pass over the images.")
+    parser.add_argument("--input", default="data/input")
+    parser.add_argument("--output", default="data/compare-output")
+    parser.add_argument("--core-prefix", default="2", help="Only process cores whose ID starts with this")
+    parser.add_argument("--since", help="Only images captured at or after this time, e.g. '2024-01-25 05:00'")
+    parser.add_argument("--until", help="Only images captured at or before this time")
+    parser.add_argument("--methods", nargs="+", default=list(METHODS), choices=list(METHODS))
+    parser.add_argument("--sam-checkpoint", help="Also run Segment Anything with this checkpoint")
+    parser.add_argument("--sam-model", default="vit_h")
+    parser.add_argument("--calibration-factor", type=float, default=0.0039016750486215255)
+    parser.add_argument("--preflight", action="store_true", help="Skip frames failing the quality check")
+    parser.add_argument("--thresholds", help="JSON (inline or file) overriding quality.DEFAULT_THRESHOLDS; implies --preflight")
+    parser.add_argument("--multires", action="store_true", help="Run the combined method coarse-to-fine")
+    args = parser.parse_args()
+
+    methods = {name: METHODS[name] for name in args.methods}
+    if args.multires and "combined" in methods:
+        methods["combined"] = (measure_combined_multires, METHODS["combined"][1])
+    if args.sam_checkpoint:
+        methods["sam"] = (sam_method(args.sam_checkpoint, args.sam_model), 4)
+
+    start = time.perf_counter()
+    results = process_directory(
+        select_images(args.input, core_prefix=args.core_prefix, since=args.since, until=args.until), methods, args.calibration_factor, args.output,
+        load_json(args.thresholds) if args.thresholds else ({} if args.preflight else None),
+    )
+    print(f"Processed {len(results)} images with {len(methods)} methods in {time.perf_counter() - start:.1f}s")
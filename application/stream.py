@@ -0,0 +1,216 @@
+import os
+import csv
+import time
+import queue
+import argparse
+import threading
+import cv2
+import numpy as np
+from process import segment_image, get_filtered_contours, analyze_contours
+
+def video_rows(path, rows_per_frame=None, band_top=None, min_response=0.05):
+    """Yield row blocks from a video of the core moving up through the camera's view.
+
+    With ``rows_per_frame`` set, only a band of that many rows (centred, or starting at
+    ``band_top``) is taken from each frame, i.e. the core advances that many pixels per
+    frame. Without it, the advance between consecutive frames is estimated by phase
+    correlation and only the rows that are new in each frame, at its bottom, are
+    taken; the first frame is taken whole. Frames whose correlation response is below
+    ``min_response`` reuse the last reliable advance.
+    """
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError(f"Unable to open video: {path}")
+    try:
+        previous = None
+        window = None
+        advance = 0
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            if rows_per_frame:
+                top = band_top if band_top is not None else (frame.shape[0] - rows_per_frame) // 2
+                yield frame[top:top + rows_per_frame]
+                continue
+
+            gray = np.float32(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+            if previous is None:
+                window = cv2.createHanningWindow((gray.shape[1], gray.shape[0]), cv2.CV_32F)
+                previous = gray
+                yield frame
+                continue
+
+            (_, shift_y), response = cv2.phaseCorrelate(previous, gray, window)
+            if response >= min_response:
+                advance = int(round(-shift_y))
+            if advance < 0:
+                raise ValueError("The core moves down through the view; give rows_per_frame and band_top instead")
+            previous = gray
+            if advance:
+                yield frame[frame.shape[0] - advance:]
+    finally:
+        capture.release()
+
+def raw_rows(path, width, rows_per_read=64):
+    """Yield row blocks from a raw line-scan dump of 8-bit BGR pixels, ``width`` pixels per line."""
+    line_bytes = width * 3
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(line_bytes * rows_per_read)
+            if len(data) < line_bytes:
+                break
+            rows = len(data) // line_bytes
+            yield np.frombuffer(data[:rows * line_bytes], dtype=np.uint8).reshape(rows, width, 3)
+
+def buffered(source, max_blocks):
+    """Read a row source on a background thread through a bounded queue.
+
+    Memory stays bounded by ``max_blocks``; the returned stats count how often the
+    reader had to wait for processing, i.e. how often processing fell behind capture.
+    """
+    blocks = queue.Queue(maxsize=max_blocks)
+    stats = {"stalls": 0, "error": None}
+    done = object()
+
+    def read():
+        try:
+            for block in source:
+                try:
+                    blocks.put_nowait(block)
+                except queue.Full:
+                    stats["stalls"] += 1
+                    blocks.put(block)
+        except Exception as e:
+            stats["error"] = e
+        finally:
+            blocks.put(done)
+
+    threading.Thread(target=read, daemon=True).start()
+
+    def generate():
+        while True:
+            block = blocks.get()
+            if block is done:
+                if stats["error"] is not None:
+                    raise stats["error"]
+                return
+            yield block
+
+    return generate(), stats
+
+def measure_strip(strip, top, owned_top, owned_bottom, at_start, at_end, calibration_factor, max_length_mm, params=None):
+    """Fit ellipses in one strip, keeping only whole grains centred in its owned rows (global y coordinates)."""
+    binary = segment_image(strip, params)
+    ellipses = []
+
+    for contour in get_filtered_contours(binary):
+        # Grains cut by the top or bottom of the strip are measured whole in the neighbouring strip
+        _, y, _, h = cv2.boundingRect(contour)
+        if (y == 0 and not at_start) or (y + h == strip.shape[0] and not at_end):
+            continue
+
+        found = analyze_contours([contour], max_length_mm, calibration_factor)
+        if not found:
+            continue
+        x_pos, y_pos, angle, major_axis, minor_axis = found[0]
+        y_pos += top
+        if owned_top <= y_pos < owned_bottom:
+            ellipses.append([x_pos, y_pos, angle, major_axis, minor_axis])
+
+    return ellipses
+
+def process_stream(blocks, calibration_factor, max_length_mm, strip_height=1024, overlap=128, params=None):
+    """Yield the ellipses of consecutive overlapping strips assembled from a stream of row blocks.
+
+    Consecutive strips share ``overlap`` rows and the seam is placed in the middle of
+    the overlap: each grain belongs to the strip holding its centre, so grains up to
+    ``overlap`` pixels across are counted exactly once.
+    """
+    if overlap >= strip_height:
+        raise ValueError("overlap must be smaller than strip_height")
+
+    buffer = None
+    top = 0
+    owned_top = 0
+    at_start = True
+
+    for block in blocks:
+        buffer = block if buffer is None else np.concatenate((buffer, block))
+        while buffer.shape[0] >= strip_height:
+            strip = buffer[:strip_height]
+            owned_bottom = top + strip_height - overlap // 2
+            yield measure_strip(strip, top, owned_top, owned_bottom, at_start, False, calibration_factor, max_length_mm, params)
+
+            advance = strip_height - overlap
+            buffer = buffer[advance:]
+            top += advance
+            owned_top = owned_bottom
+            at_start = False
+
+    if buffer is not None and buffer.shape[0] > 0:
+        yield measure_strip(buffer, top, owned_top, float("inf"), at_start, True, calibration_factor, max_length_mm, params)
+
+def write_results(strips, grains_path, summary_path, calibration_factor, mm_per_row, start_depth_mm=0, interval_mm=10):
+    """Write every grain with its depth, plus count/mean/D50 per depth interval."""
+    intervals = {}
+    rows = 0
+
+    with open(grains_path, "w", newline="") as csvfile:
+        csvwriter = csv.writer(csvfile)
+        csvwriter.writerow(["depth_mm", "x", "y", "angle", "major_axis", "minor_axis", "minor_axis_mm"])
+        for ellipses in strips:
+            for x_pos, y_pos, angle, major_axis, minor_axis in ellipses:
+                depth_mm = start_depth_mm + y_pos * mm_per_row
+                minor_axis_mm = minor_axis * calibration_factor
+                csvwriter.writerow([depth_mm, x_pos, y_pos, angle, major_axis, minor_axis, minor_axis_mm])
+                intervals.setdefault(int(depth_mm // interval_mm), []).append(minor_axis_mm)
+                rows += 1
+
+    with open(summary_path, "w", newline="") as csvfile:
+        csvwriter = csv.writer(csvfile)
+        csvwriter.writerow(["depth_from_mm", "depth_to_mm", "average", "count", "d50"])
+        for interval in sorted(intervals):
+            lengths = intervals[interval]
+            csvwriter.writerow([
+                interval * interval_mm, (interval + 1) * interval_mm,
+                np.mean(lengths), len(lengths), np.median(lengths),
+            ])
+
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure grains along a core recorded as a video or line-scan stream.")
+    parser.add_argument("source", help="Video file, or raw BGR line-scan dump with --raw-width")
+    parser.add_argument("--raw-width", type=int, help="Line width in pixels of a raw line-scan source")
+    parser.add_argument("--rows-per-frame", type=int, help="Rows the core advances between video frames, estimated if omitted")
+    parser.add_argument("--strip-height", type=int, default=1024)
+    parser.add_argument("--overlap", type=int, default=128, help="Rows shared by consecutive strips, at least the largest grain")
+    parser.add_argument("--buffer-blocks", type=int, default=64)
+    parser.add_argument("--calibration-factor", type=float, default=0.0039016750486215255)
+    parser.add_argument("--mm-per-row", type=float, help="Core advance per row in mm, defaults to the calibration factor")
+    parser.add_argument("--start-depth-mm", type=float, default=0)
+    parser.add_argument("--interval-mm", type=float, default=10)
+    parser.add_argument("--max-length-mm", type=float, default=0.4)
+    parser.add_argument("--output", default="data/stream-output")
+    args = parser.parse_args()
+
+    if args.raw_width:
+        source = raw_rows(args.source, args.raw_width)
+    else:
+        source = video_rows(args.source, args.rows_per_frame)
+    blocks, reader_stats = buffered(source, args.buffer_blocks)
+
+    os.makedirs(args.output, exist_ok=True)
+    base_name = os.path.splitext(os.path.basename(args.source))[0]
+    start = time.perf_counter()
+    count = write_results(
+        process_stream(blocks, args.calibration_factor, args.max_length_mm, args.strip_height, args.overlap),
+        os.path.join(args.output, f"{base_name}-grains.csv"),
+        os.path.join(args.output, f"{base_name}-depth.csv"),
+        args.calibration_factor,
+        args.mm_per_row or args.calibration_factor,
+        args.start_depth_mm,
+        args.interval_mm,
+    )
+    print(f"Measured {count} grains in {time.perf_counter() - start:.1f}s, reader stalled {reader_stats['stalls']} times")
@@ -0,0 +1,217 @@
+import os
+import csv
+import time
+import argparse
+import itertools
+import multiprocessing
+from functools import partial
+import cv2
+import numpy as np
+from process import segmentation_params, get_filtered_contours, analyze_contours, load_json
+from runner import SharedImage
+from grainstats import cumulative_counts
+from catalog import select_images
+
+def expand_grid(grid):
+    """List every combination of a {parameter: [values]} grid as complete segmentation parameters."""
+    names = list(grid)
+    return [segmentation_params(dict(zip(names, values))) for values in itertools.product(*(grid[name] for name in names))]
+
+class SweepImage(SharedImage):
+    """A decoded image whose segmentation is assembled from cached per-channel masks.
+
+    ``inRange`` over three channels is the AND of one range test per channel, and the
+    gray threshold is a range test too, so each test is computed once with a lookup
+    table and reused by every grid point sharing that bound. Bounds are clipped to
+    the values actually present in each channel, so grid points that only differ
+    outside that range (e.g. a hue bound above 179) share their masks and ellipses.
+    """
+
+    def channels(self, saturation_factor):
+        return self.get(("channels", saturation_factor), lambda: cv2.split(self.saturated_hsv(saturation_factor)))
+
+    def channel_range(self, saturation_factor, channel):
+        def compute():
+            low, high, _, _ = cv2.minMaxLoc(self.channels(saturation_factor)[channel])
+            return int(low), int(high)
+
+        return self.get(("channel_range", saturation_factor, channel), compute)
+
+    def range_mask(self, key, image, lower, upper):
+        def compute():
+            values = np.arange(256)
+            table = np.where((values >= lower) & (values <= upper), 255, 0).astype(np.uint8)
+            return cv2.LUT(image, table)
+
+        return self.get(key, compute)
+
+    def colour_key(self, saturation_factor, lower, upper):
+        """Effective bounds of an HSV range, or None when no pixel can fall inside it."""
+        bounds = []
+        for channel in range(3):
+            low, high = self.channel_range(saturation_factor, channel)
+            channel_lower, channel_upper = max(lower[channel], low), min(upper[channel], high)
+            if channel_lower > channel_upper:
+                return None
+            bounds.append((channel_lower, channel_upper))
+        return saturation_factor, tuple(bounds)
+
+    def colour_mask(self, key):
+        saturation_factor, bounds = key
+        mask = None
+        for channel, (lower, upper) in enumerate(bounds):
+            channel_mask = self.range_mask(
+                ("range", saturation_factor, channel, lower, upper), self.channels(saturation_factor)[channel], lower, upper
+            )
+            mask = channel_mask if mask is None else cv2.bitwise_and(mask, channel_mask)
+        return mask
+
+    def segment_key(self, params):
+        """Parameters reduced to what changes the mask on this image."""
+        colours = tuple(
+            self.colour_key(params["saturation_factor"], params[lower], params[upper])
+            for lower, upper in (("lower_cyan", "upper_cyan"), ("lower_red", "upper_red"))
+        )
+        low, high, _, _ = self.get("gray_range", lambda: cv2.minMaxLoc(self.gray))
+        threshold = min(max(int(np.floor(params["threshold"])), int(low) - 1), int(high))
+        return colours, threshold
+
+    def segment(self, key):
+        """Same mask as segment_converted for the parameters behind ``key``."""
+        colours, threshold = key
+        binary = self.range_mask(("dark", threshold), self.gray, 0, threshold)
+        for colour in colours:
+            if colour is not None:
+                binary = cv2.bitwise_and(binary, cv2.bitwise_not(self.colour_mask(colour)))
+        return binary
+
+    def measure(self, key, calibration_factor, max_length_mm):
+        def compute():
+            ellipses = analyze_contours(get_filtered_contours(self.segment(key)), max_length_mm, calibration_factor)
+            return np.array([ellipse[4] * calibration_factor for ellipse in ellipses])
+
+        return self.get(("lengths", key), compute)
+
+def sweep_image(path, points, reference, calibration_factor, max_length_mm):
+    """Measure one image at every grid point; returns (path, [(lengths, intersection, union)], reference lengths)."""
+    image = cv2.imread(path)
+    if image is None:
+        return path, None, None
+
+    shared = SweepImage(image)
+    reference_key = shared.segment_key(reference)
+    reference_mask = shared.segment(reference_key)
+    reference_lengths = shared.measure(reference_key, calibration_factor, max_length_mm)
+
+    results = []
+    for params in points:
+        key = shared.segment_key(params)
+        if key == reference_key:
+            overlap = cv2.countNonZero(reference_mask)
+            results.append((reference_lengths, overlap, overlap))
+            continue
+        mask = shared.segment(key)
+        results.append((
+            shared.measure(key, calibration_factor, max_length_mm),
+            cv2.countNonZero(cv2.bitwise_and(mask, reference_mask)),
+            cv2.countNonZero(cv2.bitwise_or(mask, reference_mask)),
+        ))
+    return path, results, reference_lengths
+
+def ks_against(reference, samples, max_grid=4096):
+    """KS statistic between a reference sample and each of several samples (nan when either is empty)."""
+    statistics = np.full(len(samples), np.nan)
+    present = [i for i, sample in enumerate(samples) if len(sample)]
+    if not len(reference) or not present:
+        return statistics
+
+    _, counts, sizes = cumulative_counts([reference] + [samples[i] for i in present], max_grid)
+    ecdf = counts / sizes[:, None]
+    statistics[present] = np.abs(ecdf[1:] - ecdf[0]).max(axis=1)
+    return statistics
+
+def summarise(lengths):
+    return [len(lengths), np.mean(lengths) if len(lengths) else 0, np.median(lengths) if len(lengths) else 0]
+
+def init_worker():
+    # One OpenCV thread per process; the images are the unit of parallelism
+    cv2.setNumThreads(1)
+
+def sweep(paths, grid, calibration_factor, max_length_mm, output_dir, reference=None, workers=None):
+    """Evaluate every grid point on every image and write per-image and pooled results.
+
+    Each image is decoded and converted once; the reference is DEFAULT_SEGMENTATION
+    (or ``reference``), compared by mask IoU and by the KS statistic of grain sizes.
+    """
+    points = expand_grid(grid)
+    reference = expand_grid({name: [value] for name, value in (reference or {}).items()})[0]
+    varied = list(grid)
+    os.makedirs(output_dir, exist_ok=True)
+
+    pooled = [[] for _ in points]
+    intersections = np.zeros(len(points))
+    unions = np.zeros(len(points))
+    pooled_reference = []
+
+    measure = partial(
+        sweep_image, points=points, reference=reference, calibration_factor=calibration_factor, max_length_mm=max_length_mm
+    )
+    with multiprocessing.Pool(workers, initializer=init_worker) as pool, \
+            open(os.path.join(output_dir, "sweep-images.csv"), "w", newline="") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["file", "point"] + varied + ["count", "average", "d50", "iou", "ks"])
+
+        for path, results, reference_lengths in pool.imap_unordered(measure, paths):
+            if results is None:
+                print(f"Skipping unreadable image: {path}")
+                continue
+
+            ks = ks_against(reference_lengths, [lengths for lengths, _, _ in results])
+            for i, (params, (lengths, intersection, union)) in enumerate(zip(points, results)):
+                iou = intersection / union if union else 1.0
+                writer.writerow([os.path.basename(path), i] + [params[name] for name in varied] + summarise(lengths) + [iou, ks[i]])
+                pooled[i].append(lengths)
+                intersections[i] += intersection
+                unions[i] += union
+            pooled_reference.append(reference_lengths)
+
+    if not pooled_reference:
+        return []
+
+    pooled = [np.concatenate(parts) for parts in pooled]
+    pooled_reference = np.concatenate(pooled_reference)
+    ks = ks_against(pooled_reference, pooled)
+    rows = []
+    with open(os.path.join(output_dir, "sweep.csv"), "w", newline="") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["point"] + varied + ["count", "average", "d50", "iou", "ks"])
+        writer.writerow(["reference"] + [reference[name] for name in varied] + summarise(pooled_reference) + [1.0, 0.0])
+        for i, (params, lengths) in enumerate(zip(points, pooled)):
+            iou = intersections[i] / unions[i] if unions[i] else 1.0
+            row = [i] + [params[name] for name in varied] + summarise(lengths) + [iou, ks[i]]
+            writer.writerow(row)
+            rows.append(row)
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate a grid of segmentation parameters over a set of images.")
+    parser.add_argument("grid", help='JSON (inline or file) like {"threshold": [140, 160], "lower_cyan": [[30, 100, 100], [40, 100, 100]]}')
+    parser.add_argument("--input", default="data/input")
+    parser.add_argument("--output", default="data/sweep-output")
+    parser.add_argument("--core-prefix", default="2", help="Only process cores whose ID starts with this")
+    parser.add_argument("--since", help="Only images captured at or after this time, e.g. '2024-01-25 05:00'")
+    parser.add_argument("--until", help="Only images captured at or before this time")
+    parser.add_argument("--reference", help="JSON parameters of the reference result, default DEFAULT_SEGMENTATION")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--calibration-factor", type=float, default=0.0039016750486215255)
+    parser.add_argument("--max-length-mm", type=float, default=0.4)
+    args = parser.parse_args()
+
+    grid = load_json(args.grid)
+    start = time.perf_counter()
+    rows = sweep(
+        select_images(args.input, core_prefix=args.core_prefix, since=args.since, until=args.until), grid,
+        args.calibration_factor, args.max_length_mm, args.output, load_json(args.reference) if args.reference else None,
+        args.workers,
+    )
+    print(f"Evaluated {len(rows)} parameter sets in {time.perf_counter() - start:.1f}s")
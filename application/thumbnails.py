@@ -0,0 +1,89 @@
+import os
+import sqlite3
+import hashlib
+import threading
+from PIL import Image
+
+THUMBNAIL_SIZE = (96, 54)
+
+class ThumbnailCache:
+    """Persistent, content-addressed thumbnail store.
+
+    Thumbnails are saved under the SHA-1 of the image bytes, so renamed or copied
+    files share one entry. A small index maps (path, size, mtime) to the digest so
+    reopening a directory never re-reads unchanged images.
+    """
+
+    def __init__(self, cache_dir="./data/thumbnails/", size=THUMBNAIL_SIZE):
+        self.cache_dir = cache_dir
+        self.size = size
+        os.makedirs(cache_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(cache_dir, "index.sqlite"), check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT)"
+        )
+        self.conn.commit()
+
+    def thumbnail_path(self, digest):
+        return os.path.join(self.cache_dir, digest[:2], f"{digest}.png")
+
+    def lookup(self, path, stat=None):
+        """Return the cached thumbnail path for an unchanged file, or None."""
+        stat = stat or os.stat(path)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT digest FROM files WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (os.path.abspath(path), stat.st_size, stat.st_mtime_ns),
+            ).fetchone()
+        if row and os.path.exists(self.thumbnail_path(row[0])):
+            return self.thumbnail_path(row[0])
+        return None
+
+    def build(self, path):
+        """Create (or reuse) the thumbnail for a file and return its path."""
+        stat = os.stat(path)
+        cached = self.lookup(path, stat)
+        if cached:
+            return cached
+
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+
+        thumbnail_path = self.thumbnail_path(digest)
+        if not os.path.exists(thumbnail_path):
+            os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+            with Image.open(path) as img:
+                # Let the JPEG decoder skip most of the full-resolution work
+                img.draft("RGB", (self.size[0] * 2, self.size[1] * 2))
+                img = img.convert("RGB")
+                img.thumbnail(self.size)
+                tmp_path = f"{thumbnail_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                img.save(tmp_path, "PNG")
+            os.replace(tmp_path, thumbnail_path)
+
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, digest) VALUES (?, ?, ?, ?)",
+                (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, digest),
+            )
+            self.conn.commit()
+        return thumbnail_path
+
+def load_measurements(db_path="./data/jobs.sqlite"):
+    """Read grain count and D50 (mm) per file from the measurement queue, if it exists."""
+    if not os.path.exists(db_path):
+        return {}
+
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute("SELECT path, count, d50 FROM results").fetchall()
+    except sqlite3.OperationalError:
+        return {}
+    finally:
+        conn.close()
+
+    return {os.path.abspath(path): (count, d50) for path, count, d50 in rows}
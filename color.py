@@ -3,6 +3,7 @@ import os
 import csv
 import matplotlib.pyplot as plt
 import seaborn as sns
+from application.catalog import select_images
 
 def process_color_image(path, output_dir, calibration_factor, max_length_mm):
     image = cv2.imread(path)
@@ -76,10 +77,7 @@ def process_directory(directory):
     calibration_factor = 0.0039016750486215255
     max_length_mm = 3
 
-    files = sorted(
-        [f for f in os.listdir(directory) if f.startswith("2")],
-        key=lambda x: int("".join(filter(str.isdigit, x)))
-    )
+    files = [os.path.basename(path) for path in select_images(directory, core_prefix="2")]
 
     output_dir = "data/color-output"
     results = []
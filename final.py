@@ -5,7 +5,12 @@ from mpl_toolkits.axes_grid1.inset_locator import inset_axes
 import seaborn as sns
 import os
 import csv
+import argparse
 import scipy.stats as sts
+from application.quality import preflight
+from application.process import load_json
+from application.grainstats import assign_groups
+from application.catalog import select_images
 
 
 def save_image(image, filename):
@@ -37,6 +42,11 @@ def analyze_contours(contours, image, calibration_factor, max_length_mm):
 
     return ellipses_image, grain_lengths
 
+parser = argparse.ArgumentParser(description="Measure grains in the input images and plot their size distributions.")
+parser.add_argument("--thresholds", help="JSON (inline or file) overriding the pre-flight quality limits")
+args = parser.parse_args()
+thresholds = load_json(args.thresholds) if args.thresholds else None
+
 # Ensure output directory exists
 output_dir = "data/combo-output/"
 os.makedirs(output_dir, exist_ok=True)
@@ -51,96 +61,110 @@ with open(results_csv_path, "w", newline="") as csvfile:
 calibration_factor = 0.0039016750486215255
 max_length_mm = 0.4
 
+# Core types by file name pattern (first match wins) and their plot colours
+core_type_rules = [("^23380[01]", "Muddy Core"), (".*", "Sandy Core")]
+core_type_colors = {"Muddy Core": '#00447c', "Sandy Core": '#d31145'}
+
 # Store all grain lengths for combined histogram
 all_grain_lengths = []
 
+# Frames rejected by the pre-flight quality check, with the metrics that failed them
+rejected_csv_path = os.path.join(output_dir, "rejected.csv")
+with open(rejected_csv_path, "w", newline="") as csvfile:
+    csvwriter = csv.writer(csvfile)
+    csvwriter.writerow(["file", "reasons", "focus", "brightness", "overexposed", "underexposed", "grain_coverage", "colour_coverage"])
+
 # Process all images in the input directory
 input_dir = "data/input/"
-for filename in os.listdir(input_dir):
-    if filename.startswith("233") and filename.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.tiff')):
-        image_path = os.path.join(input_dir, filename)
-        image = cv2.imread(image_path)
-
-        # Convert to HSV and enhance saturation
-        saturation_factor = 1
-        hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-        hsv_image[:, :, 1] = cv2.multiply(hsv_image[:, :, 1], saturation_factor)
-        enhanced_image = cv2.cvtColor(hsv_image, cv2.COLOR_HSV2BGR)
-
-        # Create masks for cyan and red colors
-        lower_cyan = (30, 100, 100)
-        upper_cyan = (85, 255, 255)
-        lower_red = (130, 50, 50)
-        upper_red = (200, 255, 255)
-
-        mask_cyan = cv2.inRange(hsv_image, lower_cyan, upper_cyan)
-        mask_red = cv2.inRange(hsv_image, lower_red, upper_red)
-        mask = cv2.bitwise_or(mask_cyan, mask_red)
-
-        # Create color contour image
-        color_contour = cv2.bitwise_and(enhanced_image, enhanced_image, mask=mask)
-        color_contour[mask == 0] = [0, 0, 0]
-        color_contour[mask != 0] = [255, 255, 255]
-
-        # Convert to grayscale and binary
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        _, binary = cv2.threshold(gray, 128 + 32, 255, cv2.THRESH_BINARY_INV)
-
-        # Save binary image
-        base_name, _ = os.path.splitext(filename)
-        binary_path = os.path.join(output_dir, f"{base_name}-binary.jpg")
-        # save_image(binary, binary_path)
-
-        # Invert the color contour
-        inverted_color_contour = cv2.bitwise_not(color_contour)
-        sharpened_binary = cv2.bitwise_and(inverted_color_contour, inverted_color_contour, mask=binary)
-
-        # Save contour image
-        contour_path = os.path.join(output_dir, f"{base_name}-contour.jpg")
-        # save_image(sharpened_binary, contour_path)
-
-        # Convert sharpened_binary to single-channel
-        sharpened_binary_gray = cv2.cvtColor(sharpened_binary, cv2.COLOR_BGR2GRAY)
-
-        # Filter contours and analyze them
-        filtered_contours = get_filtered_contours(sharpened_binary_gray)
-        ellipses_image, grain_lengths = analyze_contours(filtered_contours, image, calibration_factor, max_length_mm)
-
-        # Save ellipses image
-        ellipses_path = os.path.join(output_dir, f"{base_name}-ellipse.jpg")
-        # save_image(ellipses_image, ellipses_path)
-
-        # Write results to CSV
-        """
-        with open(results_csv_path, "a", newline="") as csvfile:
+for image_path in select_images(input_dir, core_prefix="233"):
+    filename = os.path.basename(image_path)
+    # Skip blurred, badly exposed or empty frames before any full-resolution work
+    passed, metrics, reasons = preflight(image_path, thresholds)
+    if not passed:
+        with open(rejected_csv_path, "a", newline="") as csvfile:
             csvwriter = csv.writer(csvfile)
-            csvwriter.writerow([filename, np.mean(grain_lengths) if grain_lengths else 0, len(grain_lengths)])
-        """
-
-        # Add to combined grain lengths with color category
-        if filename.startswith("233800") or filename.startswith("233801"):
-            color = '#00447c'
-            core_type = 'Muddy Core'
-        else:
-            color = '#d31145'
-            core_type = 'Sandy Core'
-        all_grain_lengths.append((grain_lengths, color, filename, core_type))
-
-        """
-        # Plot KDE histogram for current image
-        plt.figure(figsize=(10, 6))
-        # sns.histplot(grain_lengths, bins=30, kde=False, color=color, alpha=0.1, stat="density")  # Add histogram
-        sns.kdeplot(grain_lengths, color=color, bw_adjust=0.5)  # Adjust bandwidth
-        plt.title(f"KDE Histogram of Grain Sizes (Minor Axis) - {filename}")
-        plt.xlabel("Grain Size (mm)")
-        plt.ylabel("Density")
-        plt.grid(axis='y', linestyle='--', alpha=0.7)
-
-        # Save individual histogram
-        histogram_path = os.path.join(output_dir, f"{base_name}-histogram.jpg")
-        plt.savefig(histogram_path)
-        plt.close()
-        """
+            csvwriter.writerow([filename, "; ".join(reasons)] + [metrics.get(key, "") for key in (
+                "focus", "brightness", "overexposed", "underexposed", "grain_coverage", "colour_coverage")])
+        continue
+
+    image = cv2.imread(image_path)
+
+    # Convert to HSV and enhance saturation
+    saturation_factor = 1
+    hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    hsv_image[:, :, 1] = cv2.multiply(hsv_image[:, :, 1], saturation_factor)
+    enhanced_image = cv2.cvtColor(hsv_image, cv2.COLOR_HSV2BGR)
+
+    # Create masks for cyan and red colors
+    lower_cyan = (30, 100, 100)
+    upper_cyan = (85, 255, 255)
+    lower_red = (130, 50, 50)
+    upper_red = (200, 255, 255)
+
+    mask_cyan = cv2.inRange(hsv_image, lower_cyan, upper_cyan)
+    mask_red = cv2.inRange(hsv_image, lower_red, upper_red)
+    mask = cv2.bitwise_or(mask_cyan, mask_red)
+
+    # Create color contour image
+    color_contour = cv2.bitwise_and(enhanced_image, enhanced_image, mask=mask)
+    color_contour[mask == 0] = [0, 0, 0]
+    color_contour[mask != 0] = [255, 255, 255]
+
+    # Convert to grayscale and binary
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    _, binary = cv2.threshold(gray, 128 + 32, 255, cv2.THRESH_BINARY_INV)
+
+    # Save binary image
+    base_name, _ = os.path.splitext(filename)
+    binary_path = os.path.join(output_dir, f"{base_name}-binary.jpg")
+    # save_image(binary, binary_path)
+
+    # Invert the color contour
+    inverted_color_contour = cv2.bitwise_not(color_contour)
+    sharpened_binary = cv2.bitwise_and(inverted_color_contour, inverted_color_contour, mask=binary)
+
+    # Save contour image
+    contour_path = os.path.join(output_dir, f"{base_name}-contour.jpg")
+    # save_image(sharpened_binary, contour_path)
+
+    # Convert sharpened_binary to single-channel
+    sharpened_binary_gray = cv2.cvtColor(sharpened_binary, cv2.COLOR_BGR2GRAY)
+
+    # Filter contours and analyze them
+    filtered_contours = get_filtered_contours(sharpened_binary_gray)
+    ellipses_image, grain_lengths = analyze_contours(filtered_contours, image, calibration_factor, max_length_mm)
+
+    # Save ellipses image
+    ellipses_path = os.path.join(output_dir, f"{base_name}-ellipse.jpg")
+    # save_image(ellipses_image, ellipses_path)
+
+    # Write results to CSV
+    """
+    with open(results_csv_path, "a", newline="") as csvfile:
+        csvwriter = csv.writer(csvfile)
+        csvwriter.writerow([filename, np.mean(grain_lengths) if grain_lengths else 0, len(grain_lengths)])
+    """
+
+    # Add to combined grain lengths with color category
+    core_type = assign_groups([filename], core_type_rules)[filename]
+    color = core_type_colors[core_type]
+    all_grain_lengths.append((grain_lengths, color, filename, core_type))
+
+    """
+    # Plot KDE histogram for current image
+    plt.figure(figsize=(10, 6))
+    # sns.histplot(grain_lengths, bins=30, kde=False, color=color, alpha=0.1, stat="density")  # Add histogram
+    sns.kdeplot(grain_lengths, color=color, bw_adjust=0.5)  # Adjust bandwidth
+    plt.title(f"KDE Histogram of Grain Sizes (Minor Axis) - {filename}")
+    plt.xlabel("Grain Size (mm)")
+    plt.ylabel("Density")
+    plt.grid(axis='y', linestyle='--', alpha=0.7)
+
+    # Save individual histogram
+    histogram_path = os.path.join(output_dir, f"{base_name}-histogram.jpg")
+    plt.savefig(histogram_path)
+    plt.close()
+    """
 
 
 plt.figure(figsize=(12, 8))
@@ -190,10 +214,7 @@ for grain_lengths, color, filename, core_type in all_grain_lengths:
 ax_inset.grid(False)
 
 # Add legend for core types and move it to the bottom-right corner
-handles = [
-    plt.Line2D([0], [0], color='#00447c', lw=2, label='Muddy Core'),
-    plt.Line2D([0], [0], color='#d31145', lw=2, label='Sandy Core')
-]
+handles = [plt.Line2D([0], [0], color=color, lw=2, label=core_type) for core_type, color in core_type_colors.items()]
 plt.legend(handles=handles, title="Core Types", loc="upper right")
 
 